@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import time
+import random
+from scrimbot.partition import partition, spread
+from scrimbot.util import chunks
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the balanced party partitioning against a naive split.")
+    parser.add_argument("-r", "--rounds", type=int, default=20, help="number of random parties to split per size")
+    parser.add_argument("-g", "--group-size", type=int, default=6, help="maximum number of players per group")
+    parser.add_argument("-b", "--budget", type=float, default=0.05, help="time budget per split, in seconds")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed for the random players")
+    parser.add_argument("sizes", type=int, nargs="*", default=[8, 12, 16, 24, 32, 48, 64], help="party sizes to benchmark")
+    return parser
+
+
+def benchmark(sizes, group_size, rounds, budget, seed):
+    rng = random.Random(seed)
+
+    print("{0:>5} {1:>10} {2:>10} {3:>12} {4:>12}".format("size", "avg ms", "max ms", "spread", "chunks"))
+    for size in sizes:
+        timings = []
+        spreads = []
+        naive = []
+        for _ in range(rounds):
+            players = [(str(i), rng.gauss(1500, 250), rng.randint(1, 60)) for i in range(size)]
+            lookup = {player[0]: player for player in players}
+
+            start = time.time()
+            groups = partition(players, group_size, budget)
+            timings.append(time.time() - start)
+
+            spreads.append(spread([[lookup[guid] for guid in group] for group in groups])[0])
+            naive.append(spread(chunks(players, group_size))[0])
+
+        print("{0:>5} {1:>10.2f} {2:>10.2f} {3:>12.2f} {4:>12.2f}".format(size, sum(timings) / rounds * 1000, max(timings) * 1000, sum(spreads) / rounds, sum(naive) / rounds))
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    benchmark(args.sizes, args.group_size, args.rounds, args.budget, args.seed)
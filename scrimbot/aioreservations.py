@@ -0,0 +1,817 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import asyncio
+import logging
+import functools
+import itertools
+import threading
+import concurrent.futures
+from abc import ABCMeta, abstractmethod
+import hawkenapi.exceptions
+from hawkenapi.mappings import MatchState
+from scrimbot.metrics import get_metrics
+from scrimbot.util import enum, gen_composite_player, calc_fitness, fitness_fields
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+ReservationResult = enum(READY=0, CANCELED=1, TIMEOUT=2, NOTFOUND=3, ERROR=4)
+
+
+class NoSuchServer(Exception):
+    pass
+
+
+def created(f):
+    def create_required(self, *args, **kwargs):
+        if not self.created:
+            raise ValueError("Reservation has not been created yet")
+
+        return f(self, *args, **kwargs)
+
+    return create_required
+
+
+def notcreated(f):
+    def notcreate_required(self, *args, **kwargs):
+        if self.created:
+            raise ValueError("Reservation has already been created")
+
+        return f(self, *args, **kwargs)
+
+    return notcreate_required
+
+
+class PollingPolicy:
+    def __init__(self, base, cap, fast, error_backoff):
+        self.base = base
+        self.cap = cap
+        self.fast = fast
+        self.error_backoff = error_backoff
+
+        self._attempts = 0
+        self._delay = base
+
+    def next(self, error=False):
+        self._attempts += 1
+
+        if self._attempts <= self.fast:
+            # Poll quickly at first, most reservations complete within a few checks
+            delay = self.base
+        else:
+            # Back off exponentially with decorrelated jitter
+            delay = min(self.cap, random.uniform(self.base, self._delay * 3))
+
+        self._delay = delay
+
+        # Back off further when the API is struggling
+        if error:
+            delay *= self.error_backoff
+
+        return delay
+
+
+class ReservationExecutor:
+    def __init__(self, config):
+        self.config = config
+
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+
+        # Register config
+        self.config.register("api.advertisement.executor.max_workers", 16)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.api.advertisement.executor.max_workers)
+
+    def _update_gauges(self):
+        metrics.gauge("executor_queued", self._queued)
+        metrics.gauge("executor_running", self._running)
+
+    def _run(self, queued, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._update_gauges()
+
+        metrics.timing("executor_wait", time.time() - queued)
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._update_gauges()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self._queued += 1
+            self._update_gauges()
+
+        return self._executor.submit(self._run, time.time(), fn, args, kwargs)
+
+
+class ReservationEngine:
+    def __init__(self, config):
+        self.config = config
+        self.executor = get_executor(config)
+
+        self._next_poll = 0
+
+        # Register config
+        self.config.register("api.advertisement.poller.spacing", 0.05)
+
+        # Run the event loop in its own thread
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="reservations")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def call(self, fn, *args, **kwargs):
+        # Run a blocking call on the reservation executor
+        return await self.loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def pace(self):
+        # Space out advertisement checks across all reservations
+        now = self.loop.time()
+        slot = max(now, self._next_poll)
+        self._next_poll = slot + self.config.api.advertisement.poller.spacing
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_executor(config):
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ReservationExecutor(config)
+
+        return _executor
+
+
+def get_engine(config):
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            _engine = ReservationEngine(config)
+
+        return _engine
+
+
+class AsyncReservation(metaclass=ABCMeta):
+    def __init__(self, config, cache, api, stats=None):
+        self._config = config
+        self._cache = cache
+        self._api = api
+        self._stats = stats
+        self._engine = get_engine(config)
+
+        self.guid = None
+        self.advertisement = None
+        self.result = None
+        self.exception = None
+        self.polls = 0
+
+        self._limit = None
+        self._canceled = False
+        self._polling = False
+        self._task = None
+        self._delete_task = None
+
+    async def _poll(self):
+        policy = self._create_poll_policy()
+        start = self._engine.loop.time()
+        self._polling = True
+
+        try:
+            while True:
+                # Check if the advertisement has been canceled
+                if self._canceled:
+                    logger.debug("Reservation {0} has been canceled. Stopped polling.".format(self.guid))
+                    self.result = ReservationResult.CANCELED
+                    break
+
+                # Check for a timeout
+                remaining = start + self._limit - self._engine.loop.time()
+                if remaining <= 0:
+                    self.result = ReservationResult.TIMEOUT
+                    break
+
+                # Check the advertisement
+                await self._engine.pace()
+                self.polls += 1
+                metrics.increment("polls")
+                try:
+                    self.advertisement = await self._engine.call(self._api.get_advertisement, self.guid)
+                except hawkenapi.exceptions.RetryLimitExceeded:
+                    # Continue polling the advertisement after backing off
+                    logger.debug("Retry limit exceeded while polling reservation {0}.".format(self.guid))
+                    metrics.increment("retry_limit")
+                    delay = policy.next(error=True)
+                else:
+                    # Check if the advertisement still exists
+                    if self.advertisement is None:
+                        # Couldn't find reservation
+                        logger.warning("Reservation {0} cannot be found! Stopped polling.".format(self.guid))
+                        self.result = ReservationResult.NOTFOUND
+                        break
+                    # Check if the reservation has been completed
+                    elif self.advertisement["ReadyToDeliver"]:
+                        # Ready
+                        self._record_ready(self._engine.loop.time() - start)
+                        self.result = ReservationResult.READY
+                        break
+
+                    delay = policy.next()
+
+                # Wait a bit before checking again, without sleeping past the polling limit
+                await asyncio.sleep(max(0, min(delay, start + self._limit - self._engine.loop.time())))
+        except asyncio.CancelledError:
+            # Canceled while waiting on the API
+            logger.debug("Reservation {0} has been canceled. Stopped polling.".format(self.guid))
+            self.result = ReservationResult.CANCELED
+        except Exception as e:
+            self.result = ReservationResult.ERROR
+            self.exception = e
+        finally:
+            self._polling = False
+
+        # Clean up the advertisement if it was not successful
+        if self.result != ReservationResult.READY:
+            try:
+                await self.delete()
+            except asyncio.CancelledError:
+                # The delete is shielded and carries on, the result stands
+                pass
+            except Exception as e:
+                if self.exception is None:
+                    self.result = ReservationResult.ERROR
+                    self.exception = e
+
+        return self.result
+
+    def _record_ready(self, elapsed):
+        # Track how many checks it took to get ready, for tuning the polling profiles
+        profile = self._poll_profile()
+
+        logger.debug("Reservation {0} ready after {1} polls ({2:.2f}s).".format(self.guid, self.polls, elapsed))
+        metrics.increment("ready.{0}".format(profile))
+        metrics.increment("ready_polls.{0}".format(profile), self.polls)
+        metrics.timing("ready_time.{0}".format(profile), elapsed)
+
+    @abstractmethod
+    def _poll_profile(self):
+        pass
+
+    def _poll_limit(self):
+        return self._config.api.advertisement.polling_limit[self._poll_profile()]
+
+    def _create_poll_policy(self):
+        profile = self._poll_profile()
+        advertisement = self._config.api.advertisement
+
+        return PollingPolicy(advertisement.polling_rate[profile], advertisement.polling_max[profile], advertisement.polling_fast[profile], advertisement.polling_error_backoff)
+
+    @abstractmethod
+    def _reserve(self):
+        pass
+
+    def _get_user_stats(self, users):
+        if self._stats is None:
+            return self._api.get_user_stats(users)
+
+        return self._stats.get_many(users, fields=fitness_fields)
+
+    @abstractmethod
+    def _check(self):
+        pass
+
+    async def check(self):
+        return await self._engine.call(self._check)
+
+    @notcreated
+    async def reserve(self, limit=None):
+        if limit is None:
+            limit = self._poll_limit()
+
+        # Place the reservation
+        self.guid = await self._engine.call(self._reserve)
+        self._limit = limit
+
+    @created
+    def start(self):
+        # Start polling, must be called from the event loop
+        if self._task is None:
+            self._task = self._engine.loop.create_task(self._poll())
+
+        return self._task
+
+    @created
+    async def poll(self):
+        # Shield the polling so a caller giving up does not stop it
+        task = self.start()
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Only swallow the cancellation if it was the polling that got canceled, not the caller
+            if not task.cancelled():
+                raise
+
+            self.result = ReservationResult.CANCELED
+            return self.result
+
+        # Raise the exception encountered during polling
+        if result == ReservationResult.ERROR:
+            raise self.exception
+
+        return result
+
+    @created
+    async def cancel(self):
+        # Mark as canceled
+        self._canceled = True
+
+        # Delete advertisement
+        await self.delete()
+
+        # Stop polling right away instead of waiting for the next check, leaving the cleanup be
+        if self._task is not None and self._polling and not self._task.done():
+            self._task.cancel()
+
+    @created
+    async def delete(self):
+        if self._delete_task is None:
+            self._delete_task = self._engine.loop.create_task(self._engine.call(self._api.delete_advertisement, self.guid))
+
+        task = self._delete_task
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            # Forget the failed delete so it can be retried
+            if task.done() and self._delete_task is task:
+                self._delete_task = None
+            raise
+
+    @property
+    def created(self):
+        return self.guid is not None
+
+    @property
+    def finished(self):
+        return self._task is not None and self._task.done()
+
+    @property
+    def deleted(self):
+        return self._delete_task is not None and self._delete_task.done() and not self._delete_task.cancelled() and self._delete_task.exception() is None
+
+
+class AsyncServerReservation(AsyncReservation):
+    def __init__(self, config, cache, api, server, users, party=None, stats=None):
+        super().__init__(config, cache, api, stats)
+
+        self.users = users
+        self.party = party
+
+        # Validate the number of users
+        if len(self.users) < 1:
+            raise ValueError("No users were given")
+
+        if isinstance(server, str):
+            # Grab the server info
+            self.server = self._api.get_server(server)
+            if self.server is None:
+                raise NoSuchServer("The specified server does not exist")
+        else:
+            # Assume it's a server object
+            self.server = server
+
+    def _poll_profile(self):
+        return "server"
+
+    def _reserve(self):
+        return self._api.create_server_advertisement(self.server["GameVersion"], self.server["Region"], self.server["Guid"], self.users, party=self.party)
+
+    def _check(self):
+        critical = False
+        issues = []
+
+        # Check for critical issues
+        # Server is too small to hold the number of users
+        if self.server["MaxUsers"] < len(self.users):
+            issues.append("Error: There are too many users to fit into the server ({0}/{1}).".format(len(self.users), self.server["MaxUsers"]))
+            critical = True
+        # Server marked as unavailable
+        if int(self.server["DeveloperData"]["MatchState"]) == MatchState.unavailable:
+            issues.append("Error: The server is currently not available. It may be switching maps or otherwise not ready for new players.")
+            critical = True
+        # Check for warnings
+        else:
+            # Server is full
+            if self.server["MaxUsers"] < (len(self.server["Users"]) + len(self.users)):
+                issues.append("Warning: Server does not have enough room for all players ({0}/{1}) - reservation may fail!".format(len(self.server["Users"]) + len(self.users), self.server["MaxUsers"]))
+            # Server outside the users's fitness range
+            if self.server["DeveloperData"]["bIgnoreMMR"] == "FALSE" and int(self.server["DeveloperData"]["AveragePilotLevel"]) > 0 and int(self.server["ServerRanking"]) > 0:
+                try:
+                    data = self._get_user_stats(self.users)
+                except hawkenapi.exceptions.InvalidBatch:
+                    # No use crying over spilled milk - just ignore the check
+                    pass
+                else:
+                    composite = gen_composite_player(data, fitness_fields)
+                    score, health, rating, details = calc_fitness(self._cache["globals"], composite, self.server)
+                    if rating == 0:
+                        issues.append("Warning: Server outside player fitness range ({0}) - reservation may fail!".format(health))
+            # Match is in progress
+            if int(self.server["DeveloperData"]["MatchState"]) == MatchState.inprogress:
+                issues.append("Warning: Match already underway.")
+
+        return critical, issues
+
+
+class AsyncMatchmakingReservation(AsyncReservation):
+    def __init__(self, config, cache, api, gameversion, region, users, gametype=None, party=None, stats=None):
+        super().__init__(config, cache, api, stats)
+
+        self.gameversion = gameversion
+        self.region = region
+        self.users = users
+        self.gametype = gametype
+        self.party = party
+
+        # Validate the number of users
+        if len(self.users) < 1:
+            raise ValueError("No users were given")
+
+    def _poll_profile(self):
+        return "matchmaking"
+
+    def _reserve(self):
+        return self._api.create_matchmaking_advertisement(self.gameversion, self.region, self.users, gametype=self.gametype, party=self.party)
+
+    def _check(self):
+        critical = False
+        issues = []
+
+        # TODO: Perform checks
+
+        return critical, issues
+
+
+class AsyncSynchronizedReservation(metaclass=ABCMeta):
+    def __init__(self, config):
+        self._config = config
+        self._engine = get_engine(config)
+
+        self.reservations = []
+
+        self._created = False
+
+    def _add(self, reservation):
+        if reservation in self.reservations:
+            raise ValueError("Reservation already added")
+
+        self.reservations.append(reservation)
+
+    def _remove(self, reservation):
+        self.reservations.remove(reservation)
+
+    @abstractmethod
+    def _check(self):
+        pass
+
+    async def check(self):
+        return await self._engine.call(self._check)
+
+    async def _gather(self, coros, message):
+        # Run the coroutines together, logging any failures
+        exception = None
+
+        for result in await asyncio.gather(*coros, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("{0} {1!r}".format(message, result))
+                if exception is None:
+                    exception = result
+
+        return exception
+
+    @notcreated
+    async def reserve(self, limit=None):
+        # Mark as created
+        self._created = True
+
+        # Place the reservations, cancelling the others if any fail
+        exception = await self._gather([reservation.reserve(limit=limit) for reservation in self.reservations], "Exception while placing reservations.")
+        if exception is not None:
+            await self.delete()
+            raise exception
+
+    @created
+    async def poll(self, limit=None):
+        exception = None
+        return_code = ReservationResult.READY
+
+        # Start polling all the reservations
+        tasks = {reservation.start(): reservation for reservation in self.reservations}
+        pending = set(tasks)
+        deadline = None if limit is None else self._engine.loop.time() + limit
+
+        while len(pending) > 0:
+            timeout = None if deadline is None else max(0, deadline - self._engine.loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if len(done) == 0:
+                # Ran out of time waiting on the reservations
+                return_code = None
+                break
+
+            # Check the results as they come in
+            code = ReservationResult.READY
+            for task in done:
+                code = ReservationResult.CANCELED if task.cancelled() else task.result()
+                if code != ReservationResult.READY:
+                    if code == ReservationResult.ERROR:
+                        exception = tasks[task].exception
+                        logger.error("Exception while polling reservations. {0!r}".format(exception))
+                    break
+
+            # Check if the reservation was not successful
+            if code != ReservationResult.READY:
+                return_code = code
+                break
+
+        # Cancel the other reservations if we did not succeed
+        if return_code != ReservationResult.READY:
+            await self.cancel()
+
+        if exception is not None:
+            raise exception
+
+        return return_code
+
+    @created
+    async def cancel(self):
+        await self._gather([reservation.cancel() for reservation in self.reservations if reservation.created], "Exception while canceling reservations.")
+
+    @created
+    async def delete(self):
+        await self._gather([reservation.delete() for reservation in self.reservations if reservation.created], "Exception while deleting reservations.")
+
+    @property
+    def created(self):
+        return self._created
+
+    @property
+    def finished(self):
+        return len(self.reservations) > 0 and all(reservation.finished for reservation in self.reservations)
+
+    @property
+    def deleted(self):
+        return len(self.reservations) > 0 and all(reservation.deleted for reservation in self.reservations)
+
+    @property
+    @abstractmethod
+    def advertisement(self):
+        pass
+
+
+class AsyncSynchronizedServerReservation(AsyncSynchronizedReservation):
+    def __init__(self, config, cache, api, server, stats=None):
+        super().__init__(config)
+
+        self._cache = cache
+        self._api = api
+        self._stats = stats
+
+        self.user_groups = []
+
+        if isinstance(server, str):
+            # Grab the server info
+            self.server = self._api.get_server(server)
+            if self.server is None:
+                raise NoSuchServer("The specified server does not exist")
+        else:
+            # Assume it's a server object
+            self.server = server
+
+    @notcreated
+    def add(self, users, party=None):
+        reservation = AsyncServerReservation(self._config, self._cache, self._api, self.server, users, party, self._stats)
+        self._add(reservation)
+        self.user_groups.append(users)
+
+    @notcreated
+    def remove(self, users, party):
+        raise NotImplementedError("Removing user groups is not implemented")
+
+    def _check(self):
+        critical = False
+        issues = []
+
+        user_count = sum([len(users) for users in self.user_groups])
+
+        # Check for critical issues
+        # Server is too small to hold the number of users
+        if self.server["MaxUsers"] < user_count:
+            issues.append("Error: There are too many users to fit into the server ({0}/{1}).".format(user_count, self.server["MaxUsers"]))
+            critical = True
+        # Check for warnings
+        else:
+            # Server is full
+            if self.server["MaxUsers"] < (len(self.server["Users"]) + user_count):
+                issues.append("Warning: Server does not have enough room for all players ({0}/{1}) - reservation may fail!".format(len(self.server["Users"]) + user_count, self.server["MaxUsers"]))
+
+            # Load user data
+            try:
+                users = set(itertools.chain.from_iterable(self.user_groups))
+                if self._stats is None:
+                    stats = self._api.get_user_stats(users)
+                else:
+                    stats = self._stats.get_many(users, fields=fitness_fields)
+                userdata = {user["Guid"]: user for user in stats}
+            except hawkenapi.exceptions.InvalidBatch:
+                # No use crying over spilled milk - just ignore the check
+                pass
+            else:
+                data = []
+                for group in self.user_groups:
+                    data.append([userdata[user] for user in group])
+
+                composites = [gen_composite_player(group, fitness_fields) for group in data]
+
+                # Server outside the group fitness level
+                if int(self.server["DeveloperData"]["AveragePilotLevel"]) > 0 and int(self.server["ServerRanking"]) > 0:
+                    for composite in composites:
+                        score, health, rating, details = calc_fitness(self._cache["globals"], composite, self.server)
+                        if rating == 0:
+                            issues.append("Warning: Server outside a group's fitness range ({0}) - reservation may fail!".format(health))
+
+        return critical, issues
+
+    @property
+    def advertisement(self):
+        try:
+            return self.reservations[0].advertisement
+        except IndexError:
+            return None
+
+
+class AsyncHedgedServerReservation:
+    def __init__(self, config, cache, api, servers, users, party=None, stats=None):
+        self._config = config
+        self._engine = get_engine(config)
+
+        self.users = users
+        self.party = party
+        self.winner = None
+
+        # Validate the number of servers
+        if len(servers) < 1:
+            raise ValueError("No servers were given")
+
+        self.reservations = [AsyncServerReservation(config, cache, api, server, users, party, stats) for server in servers]
+
+        # Remember each candidate's original rank, the list shrinks as candidates are dropped
+        self.ranks = {reservation: rank for rank, reservation in enumerate(self.reservations)}
+
+        self._created = False
+
+    def _check(self):
+        # Drop the servers that cannot take the reservation
+        issues = []
+        for reservation in list(self.reservations):
+            critical, reservation_issues = reservation._check()
+            if critical:
+                self.reservations.remove(reservation)
+                if len(self.reservations) == 0:
+                    issues.extend(reservation_issues)
+
+        return len(self.reservations) == 0, issues
+
+    async def check(self):
+        return await self._engine.call(self._check)
+
+    @notcreated
+    async def reserve(self, limit=None):
+        # Mark as created
+        self._created = True
+
+        # Place the reservations, keeping the ones that succeeded
+        results = await asyncio.gather(*[reservation.reserve(limit=limit) for reservation in self.reservations], return_exceptions=True)
+
+        exception = None
+        for reservation, result in zip(list(self.reservations), results):
+            if isinstance(result, Exception):
+                logger.error("Exception while placing hedged reservation on {0}. {1!r}".format(reservation.server["Guid"], result))
+                self.reservations.remove(reservation)
+                if exception is None:
+                    exception = result
+
+        if len(self.reservations) == 0:
+            raise exception
+
+    @created
+    async def poll(self, limit=None):
+        exception = None
+        return_code = None
+
+        # Start polling all the reservations
+        tasks = {reservation.start(): reservation for reservation in self.reservations}
+        pending = set(tasks)
+        deadline = None if limit is None else self._engine.loop.time() + limit
+
+        while len(pending) > 0 and self.winner is None:
+            timeout = None if deadline is None else max(0, deadline - self._engine.loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if len(done) == 0:
+                # Ran out of time waiting on the reservations
+                return_code = None
+                break
+
+            # Take the first reservation that is ready
+            for task in done:
+                return_code = ReservationResult.CANCELED if task.cancelled() else task.result()
+                if return_code == ReservationResult.READY:
+                    self.winner = tasks[task]
+                    metrics.increment("hedge_wins.{0}".format(self.ranks[self.winner]))
+                    break
+                elif return_code == ReservationResult.ERROR:
+                    exception = tasks[task].exception
+                    logger.error("Exception while polling hedged reservation. {0!r}".format(exception))
+
+        # Cancel the rest
+        await self._gather_cancel(reservation for reservation in self.reservations if reservation is not self.winner)
+
+        if self.winner is not None:
+            return ReservationResult.READY
+
+        # Nothing came through, raise the error if that is how the last one ended
+        if return_code == ReservationResult.ERROR:
+            raise exception
+
+        return return_code
+
+    async def _gather_cancel(self, reservations):
+        for result in await asyncio.gather(*[reservation.cancel() for reservation in reservations], return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Exception while canceling hedged reservations. {0!r}".format(result))
+
+    @created
+    async def cancel(self):
+        await self._gather_cancel(self.reservations)
+
+    @created
+    async def delete(self):
+        for result in await asyncio.gather(*[reservation.delete() for reservation in self.reservations], return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Exception while deleting hedged reservations. {0!r}".format(result))
+
+    @property
+    def created(self):
+        return self._created
+
+    @property
+    def finished(self):
+        return self.winner is not None or (len(self.reservations) > 0 and all(reservation.finished for reservation in self.reservations))
+
+    @property
+    def deleted(self):
+        return all(reservation.deleted for reservation in self.reservations if reservation is not self.winner)
+
+    @property
+    def server(self):
+        if self.winner is not None:
+            return self.winner.server
+
+        return self.reservations[0].server
+
+    @property
+    def advertisement(self):
+        if self.winner is not None:
+            return self.winner.advertisement
+
+        return None
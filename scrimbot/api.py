@@ -114,6 +114,11 @@ class ApiClient(hawkenapi.client.Client):
         self.config.register("api.advertisement.polling_rate.matchmaking", 1)
         self.config.register("api.advertisement.polling_limit.server", 15.0)
         self.config.register("api.advertisement.polling_limit.matchmaking", 300.0)
+        self.config.register("api.advertisement.polling_max.server", 2.0)
+        self.config.register("api.advertisement.polling_max.matchmaking", 5.0)
+        self.config.register("api.advertisement.polling_fast.server", 4)
+        self.config.register("api.advertisement.polling_fast.matchmaking", 2)
+        self.config.register("api.advertisement.polling_error_backoff", 2.0)
 
     def setup(self):
         # Init the underlying client
@@ -124,6 +129,9 @@ class ApiClient(hawkenapi.client.Client):
             import hawkenapi.cache
             self.cache = hawkenapi.cache.Cache(self.config.api.cache.prefix, **self.config.api.cache.params)
 
-        # Authenticate to the API and grab the user's callsign
+        # Authenticate to the API
         self.storm_login(self.config.api.username, self.config.api.password)
+
+    def load_callsign(self):
+        # Grab the user's callsign
         self.callsign = self.get_user_callsign(self.guid)
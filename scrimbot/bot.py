@@ -4,15 +4,21 @@
 import logging
 import time
 import sleekxmpp
-import sleekxmpp.xmlstream.scheduler
 
 from scrimbot.api import ApiClient
 from scrimbot.cache import Cache
 from scrimbot.command import CommandManager, CommandType
 from scrimbot.config import Config
+from scrimbot.outbound import MessageQueue
 from scrimbot.party import PartyManager
-from scrimbot.permissions import PermissionHandler
+from scrimbot.permissions import PermissionHandler, AdmissionList
 from scrimbot.plugins.base import PluginManager
+from scrimbot.resolver import UserResolver
+from scrimbot.rooms import RoomRouter
+from scrimbot.servers import ServerDirectory
+from scrimbot.startup import StartupPipeline
+from scrimbot.stats import PlayerStatsStore
+from scrimbot.timers import TimerService
 from scrimbot.util import jid_user, default_logging
 
 logger = logging.getLogger(__name__)
@@ -20,8 +26,11 @@ logger = logging.getLogger(__name__)
 
 # XMPP Client
 class ScrimBotClient(sleekxmpp.ClientXMPP):
-    def __init__(self, api):
+    def __init__(self, config, api, resolver):
         self.hawkenapi = api
+        self.resolver = resolver
+        self.outbound = MessageQueue(config, self._send_message)
+        self.rooms = RoomRouter()
 
     def setup(self, user, server, auth, **kwargs):
         # Init the client
@@ -46,8 +55,35 @@ class ScrimBotClient(sleekxmpp.ClientXMPP):
         self.register_plugin("hawken")  # Hawken
         self.register_plugin("hawken_party")  # Hawken Party
 
+        # Route all the room events through a single handler
+        self.add_event_handler("muc_room", self.rooms.dispatch)
+        self.add_event_handler("session_end", self.rooms.session_end)
+
+    def event(self, name, data={}, direct=False):
+        # Send events for routed rooms to the room router, rather than looking up a handler per room
+        if name.startswith("muc::"):
+            room, _, kind = name[5:].rpartition("::")
+            if room in self.rooms:
+                return super().event("muc_room", (room, kind, data), direct)
+
+        return super().event(name, data, direct)
+
     def send_message(self, mtype, mto, mbody, now=False):
         # Override the send_message function to support PMs and parties
+        if mtype not in (CommandType.PM, CommandType.PARTY):
+            raise NotImplementedError("Unsupported message type")
+
+        if now:
+            # Bypass the outbound queue
+            self._send_message(mtype, mto, mbody, now=True)
+        else:
+            self.outbound.put(mtype, mto, mbody)
+
+    def flush_messages(self, mtype, mto):
+        # Block until the queued messages to the recipient have gone out
+        return self.outbound.flush(mtype, mto)
+
+    def _send_message(self, mtype, mto, mbody, now=False):
         if mtype == CommandType.PM:
             message = super().make_message(mto, mbody=mbody, mtype="chat")
             message.send(now)
@@ -97,7 +133,7 @@ class ScrimBotClient(sleekxmpp.ClientXMPP):
         if self.client_roster[jid]["name"] == "":
             # Update the jid with the user's callsign
             user = jid_user(jid)
-            callsign = self.hawkenapi.get_user_callsign(user) or ""
+            callsign = self.resolver.get_callsign(user) or ""
 
             self.client_roster[jid]["name"] = callsign
             updated = True
@@ -122,21 +158,11 @@ class ScrimBotClient(sleekxmpp.ClientXMPP):
         return updated
 
 
-class Scheduler(sleekxmpp.xmlstream.scheduler.Scheduler):
-    def add(self, name, seconds, callback, **kwargs):
-        super().add(name, seconds, callback, **kwargs)
-        logger.debug("Registered task: {0}".format(name))
-
-    def remove(self, name):
-        super().remove(name)
-        logger.debug("Unregistered task: {0}".format(name))
-
-
 # Main Bot
 class ScrimBot:
     def __init__(self, config="config.json"):
         # Init bot data
-        self.scheduler = Scheduler()
+        self.scheduler = TimerService()
         self.connected = False
 
         # Init the config
@@ -155,50 +181,78 @@ class ScrimBot:
         if config_loaded is False:
             raise RuntimeError("Failed to load config")
 
-        # Init the API, cache, XMPP, permissions, plugins, and commands
+        # Init the API, cache, resolver, stats, servers, XMPP, permissions, plugins, and commands
         self.api = ApiClient(self.config)
         self.cache = Cache(self, self.config, self.api)
-        self.xmpp = ScrimBotClient(self.api)
+        self.resolver = UserResolver(self.config, self.cache, self.api)
+        self.stats = PlayerStatsStore(self.config, self.api)
+        self.servers = ServerDirectory(self.config, self.api, self.scheduler)
+        self.xmpp = ScrimBotClient(self.config, self.api, self.resolver)
         self.permissions = PermissionHandler(self.config, self.xmpp)
-        self.parties = PartyManager(self.config, self.api, self.cache, self.xmpp)
+        self.admission = AdmissionList(self.config, self.xmpp, self.permissions)
+        self.parties = PartyManager(self.config, self.api, self.cache, self.xmpp, self.resolver, self.stats, self.scheduler)
         self.plugins = PluginManager(self)
         self.commands = CommandManager(self.config, self.xmpp, self.permissions, self.parties, self.plugins)
 
+        # Setup the bot, running independent steps in parallel
+        self._presence = {}
+        startup = StartupPipeline()
+        startup.add("plugins", self._load_plugins)
+        startup.add("cache_load", self._load_cache, requires=["plugins"])
+        startup.add("config_save", self._save_config, requires=["plugins"])
+        startup.add("api_login", self.api.setup)
+        startup.add("api_callsign", self.api.load_callsign, requires=["api_login"])
+        startup.add("globals", self.cache.setup, requires=["api_login", "cache_load"])
+        startup.add("servers", self.servers.start, requires=["api_login", "config_save"])
+        startup.add("presence_domain", self._load_presence_domain, requires=["api_login"])
+        startup.add("presence_access", self._load_presence_access, requires=["api_login"])
+        startup.add("xmpp", self._setup_xmpp, requires=["presence_domain", "presence_access"])
+        startup.run()
+        self.startup_timings = startup.timings
+
+        # Register event handlers
+        self.xmpp.add_event_handler("session_start", self.handle_session_start)
+        self.xmpp.add_event_handler("session_end", self.handle_session_end)
+        self.xmpp.add_event_handler("killed", self.handle_killed)
+        self.xmpp.add_event_handler("roster_subscription_request", self.handle_subscription_request)
+        self.xmpp.add_event_handler("roster_subscription_remove", self.handle_subscription_remove)
+        self.xmpp.add_event_handler("roster_update", self.admission.handle_roster_update)
+        self.xmpp.add_event_handler("changed_subscription", self.admission.handle_changed_subscription)
+        self.xmpp.add_event_handler("message", self.handle_chat_message, threaded=True)
+        self.xmpp.add_event_handler("groupchat_message", self.handle_groupchat_message, threaded=True)
+        self.xmpp.add_event_handler("game_invite", self.handle_game_invite, threaded=True)
+
+    def _load_plugins(self):
         # Load plugins
         self.config.bot.plugins = list(set(self.config.bot.plugins))
         for plugin in self.config.bot.plugins:
             self.plugins.load(plugin)
 
+    def _load_cache(self):
         # Load the cache
         if self.cache.load() is None:
             # Save new cache file
             self.cache.save()
 
+    def _save_config(self):
         # Save the config before we setup the bot
         if not self.config.save():
             raise RuntimeError("Could not save config file")
 
-        # Setup the API and cache
-        self.api.setup()
-        self.cache.setup()
+    def _load_presence_domain(self):
+        self._presence["domain"] = self.api.get_presence_domain()
+
+    def _load_presence_access(self):
+        self._presence["access"] = self.api.get_presence_access()
 
+    def _setup_xmpp(self):
         # Setup the XMPP client
-        self.xmpp.setup(self.api.guid, self.api.get_presence_domain(), self.api.get_presence_access())
+        self.xmpp.setup(self.api.guid, self._presence["domain"], self._presence["access"])
 
         # Attach the scheduler to the xmpp stop event and start processing
         self.scheduler.stop = self.xmpp.stop
         self.scheduler.process()
 
-        # Register event handlers
-        self.xmpp.add_event_handler("session_start", self.handle_session_start)
-        self.xmpp.add_event_handler("session_end", self.handle_session_end)
-        self.xmpp.add_event_handler("killed", self.handle_killed)
-        self.xmpp.add_event_handler("roster_subscription_request", self.handle_subscription_request)
-        self.xmpp.add_event_handler("roster_subscription_remove", self.handle_subscription_remove)
-        self.xmpp.add_event_handler("message", self.handle_chat_message, threaded=True)
-        self.xmpp.add_event_handler("groupchat_message", self.handle_groupchat_message, threaded=True)
-        self.xmpp.add_event_handler("game_invite", self.handle_game_invite, threaded=True)
-
     def connect(self, *args, **kwargs):
         return self.xmpp.connect(*args, **kwargs)
 
@@ -218,6 +272,9 @@ class ScrimBot:
         whitelist = set(self.permissions.group_users("admin") + self.permissions.group_users("whitelist"))
         blacklist = self.permissions.group_users("blacklist")
 
+        # Resolve the callsigns for unnamed entries in one batch
+        self.resolver.get_callsigns([jid_user(jid) for jid, item in self.xmpp.roster_items() if item["name"] == ""])
+
         # Update the existing roster entries
         for jid in self.xmpp.roster_list():
             user = jid_user(jid)
@@ -263,6 +320,7 @@ class ScrimBot:
 
             # Update the roster
             self.update_roster()
+            self.admission.rebuild()
 
             # Signal the plugins that we are connected
             self.plugins.connected()
@@ -323,12 +381,8 @@ class ScrimBot:
                 logger.info("Emergency broadcast received: [{0}] {1}".format(message["subject"], message["body"]))
             else:
                 logger.info("Emergency broadcast received: {0}".format(message["body"]))
-        # Drop messages from people not friends with
-        elif not self.xmpp.has_jid(message["from"].bare):
-            pass
-        # Drop messages from users not allowed to send messages to the bot
-        elif self.permissions.user_check_group(message["from"].user, "blacklist") or \
-            (self.config.bot.whitelisted and not self.permissions.user_check_groups(message["from"].user, ("admin", "whitelist"))):
+        # Drop messages from people not friends with or not allowed to send messages to the bot
+        elif message["from"].bare not in self.admission:
             pass
         # Check if this is a normal chat message
         elif message["type"] == "chat":
@@ -363,12 +417,8 @@ class ScrimBot:
         # Drop messages that were sent while offline
         elif message["delay"]["text"] == "Offline Storage":
             pass
-        # Drop messages from people not friends with
-        elif not self.xmpp.has_jid(message["from"].bare):
-            pass
-        # Drop messages from users not allowed to send messages to the bot
-        elif self.permissions.user_check_group(message["from"].user, "blacklist") or \
-            (self.config.bot.whitelisted and not self.permissions.user_check_groups(message["from"].user, ("admin", "whitelist"))):
+        # Drop messages from people not friends with or not allowed to send messages to the bot
+        elif message["from"].bare not in self.admission:
             pass
         else:
             logger.info("Ignoring game invite from {0}.".format(message["from"].user))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Metrics:
+    def __init__(self, name):
+        self.name = name
+
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, value):
+        with self._lock:
+            try:
+                timing = self.timings[name]
+            except KeyError:
+                self.timings[name] = {"count": 1, "total": value, "min": value, "max": value, "last": value}
+            else:
+                timing["count"] += 1
+                timing["total"] += value
+                timing["min"] = min(timing["min"], value)
+                timing["max"] = max(timing["max"], value)
+                timing["last"] = value
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+    def format(self):
+        output = []
+
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                output.append("{0}={1}".format(name, value))
+            for name, value in sorted(self.gauges.items()):
+                if isinstance(value, float):
+                    output.append("{0}={1:.3f}".format(name, value))
+                else:
+                    output.append("{0}={1}".format(name, value))
+            for name, timing in sorted(self.timings.items()):
+                output.append("{0}=[avg {1:.3f}s max {2[max]:.3f}s last {2[last]:.3f}s n={2[count]}]".format(name, timing["total"] / timing["count"], timing))
+
+        return "{0}: {1}".format(self.name, ", ".join(output))
+
+
+def get_metrics(name):
+    with _registry_lock:
+        try:
+            return _registry[name]
+        except KeyError:
+            metrics = Metrics(name)
+            _registry[name] = metrics
+            return metrics
+
+
+def all_metrics():
+    with _registry_lock:
+        return [_registry[name] for name in sorted(_registry)]
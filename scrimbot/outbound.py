@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+import collections
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+def split_body(body, length):
+    # Split on line boundaries where possible, hard splitting any overlong lines
+    chunks = []
+    current = ""
+    for line in body.split("\n"):
+        while len(line) > length:
+            if current != "":
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:length])
+            line = line[length:]
+
+        if current == "":
+            current = line
+        elif len(current) + 1 + len(line) <= length:
+            current += "\n" + line
+        else:
+            chunks.append(current)
+            current = line
+
+    if current != "" or len(chunks) == 0:
+        chunks.append(current)
+
+    return chunks
+
+
+class MessageQueue:
+    def __init__(self, config, send):
+        self.config = config
+        self._send = send
+
+        self._lock = threading.Condition()
+        self._queues = {}
+        self._order = collections.deque()
+        self._depth = 0
+        self._sending = None
+        self._thread = None
+        self._next_send = 0
+
+        # Register config
+        self.config.register("bot.outbound.coalesce_window", 0.01)
+        self.config.register("bot.outbound.max_length", 1000)
+        self.config.register("bot.outbound.pacing", 0.05)
+        self.config.register("bot.outbound.flush_timeout", 5)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._process, name="outbound")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _take(self):
+        # Wait for the oldest queue to clear the coalesce window
+        with self._lock:
+            while True:
+                if len(self._order) == 0:
+                    self._lock.wait()
+                    continue
+
+                key = self._order[0]
+                wait = self._queues[key][0][1] + self.config.bot.outbound.coalesce_window - time.time()
+                if wait > 0:
+                    self._lock.wait(wait)
+                    continue
+
+                self._order.popleft()
+                messages = self._queues.pop(key)
+                self._sending = key
+                self._depth -= len(messages)
+                metrics.gauge("queue_depth", self._depth)
+
+                return key, messages
+
+    def _pace(self):
+        # Space out stanzas globally to avoid server-side throttling
+        delay = self._next_send - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        self._next_send = time.time() + self.config.bot.outbound.pacing
+
+    def _process(self):
+        while True:
+            (mtype, mto), messages = self._take()
+
+            # Coalesce the messages and split them back up to the size limit
+            body = "\n".join(message[0] for message in messages)
+            chunks = split_body(body, self.config.bot.outbound.max_length)
+
+            metrics.increment("messages", len(messages))
+            if len(messages) > 1:
+                metrics.increment("coalesced", len(messages) - 1)
+            if len(chunks) > 1:
+                metrics.increment("split", len(chunks) - 1)
+
+            for chunk in chunks:
+                self._pace()
+
+                try:
+                    self._send(mtype, mto, chunk)
+                except Exception:
+                    logger.exception("Failed to send message to {0}.".format(mto))
+                else:
+                    metrics.increment("stanzas")
+
+            metrics.timing("send_latency", time.time() - messages[0][1])
+
+            # Wake up anyone waiting for this recipient to be flushed
+            with self._lock:
+                self._sending = None
+                self._lock.notify_all()
+
+    def put(self, mtype, mto, mbody):
+        key = (mtype, str(mto))
+
+        with self._lock:
+            if key not in self._queues:
+                self._queues[key] = []
+                self._order.append(key)
+
+            self._queues[key].append((mbody, time.time()))
+            self._depth += 1
+            metrics.gauge("queue_depth", self._depth)
+
+            self._lock.notify_all()
+
+        self._start()
+
+    def flush(self, mtype, mto, timeout=None):
+        # Wait until everything queued for the recipient has been sent
+        key = (mtype, str(mto))
+        if timeout is None:
+            timeout = self.config.bot.outbound.flush_timeout
+
+        deadline = time.time() + timeout
+        with self._lock:
+            while key in self._queues or self._sending == key:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    logger.warning("Timed out flushing messages to {0}.".format(mto))
+                    return False
+
+                self._lock.wait(wait)
+
+        return True
+
+    @property
+    def depth(self):
+        return self._depth
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+def group_sizes(count, group_size):
+    # Spread the players as evenly as possible over the fewest groups that fit them
+    groups = -(-count // group_size)
+    if groups == 0:
+        return []
+
+    size, extra = divmod(count, groups)
+    return [size + 1] * extra + [size] * (groups - extra)
+
+
+def spread(groups):
+    # Gap between the strongest and weakest group, by mean rating and then by mean level
+    ratings = [sum(player[1] for player in group) / len(group) for group in groups]
+    levels = [sum(player[2] for player in group) / len(group) for group in groups]
+
+    return max(ratings) - min(ratings), max(levels) - min(levels)
+
+
+class _Search:
+    def __init__(self, players, sizes, deadline):
+        self.players = sorted(players, key=lambda player: player[1], reverse=True)
+        self.sizes = sizes
+        self.deadline = deadline
+
+        self.groups = [[] for _ in sizes]
+        self.best = None
+        self.best_spread = None
+        self.exhausted = True
+
+    def _record(self):
+        score = spread(self.groups)
+        if self.best_spread is None or score < self.best_spread:
+            self.best = [list(group) for group in self.groups]
+            self.best_spread = score
+
+    def _assign(self, index):
+        if index == len(self.players):
+            self._record()
+            return
+
+        # Give up on exhaustive search once out of time, but only after the first full split
+        if self.best is not None and time.time() > self.deadline:
+            self.exhausted = False
+            return
+
+        player = self.players[index]
+        tried_empty = set()
+        for group, size in zip(self.groups, self.sizes):
+            if len(group) >= size:
+                continue
+
+            # Empty groups of the same size are interchangeable, only try one of them
+            if len(group) == 0:
+                if size in tried_empty:
+                    continue
+                tried_empty.add(size)
+
+            group.append(player)
+            self._assign(index + 1)
+            group.pop()
+
+            if self.best_spread is not None and self.best_spread[0] == 0 and self.best_spread[1] == 0:
+                return
+
+    def run(self):
+        self._assign(0)
+        return self.best
+
+
+def _greedy(players, sizes):
+    # Hand out the strongest remaining player to the open group with the lowest total rating
+    groups = [[] for _ in sizes]
+    totals = [0] * len(sizes)
+
+    for player in sorted(players, key=lambda player: player[1], reverse=True):
+        index = min((i for i in range(len(groups)) if len(groups[i]) < sizes[i]), key=lambda i: totals[i] / sizes[i])
+        groups[index].append(player)
+        totals[index] += player[1]
+
+    return groups
+
+
+def _improve(groups, deadline):
+    # Swap players between groups while it narrows the spread, only the extreme groups can improve it
+    ratings = [sum(player[1] for player in group) for group in groups]
+    levels = [sum(player[2] for player in group) for group in groups]
+    counts = [len(group) for group in groups]
+
+    def score(rating_means, level_means):
+        return max(rating_means) - min(rating_means), max(level_means) - min(level_means)
+
+    rating_means = [ratings[i] / counts[i] for i in range(len(groups))]
+    level_means = [levels[i] / counts[i] for i in range(len(groups))]
+    current = score(rating_means, level_means)
+
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        high = max(range(len(groups)), key=rating_means.__getitem__)
+        low = min(range(len(groups)), key=rating_means.__getitem__)
+
+        for a in (high, low):
+            for b in range(len(groups)):
+                if a == b:
+                    continue
+
+                a_rating, b_rating = rating_means[a], rating_means[b]
+                a_level, b_level = level_means[a], level_means[b]
+                for i, p in enumerate(groups[a]):
+                    for j, q in enumerate(groups[b]):
+                        # Only the two groups involved in the swap change
+                        rating_means[a] = (ratings[a] - p[1] + q[1]) / counts[a]
+                        rating_means[b] = (ratings[b] - q[1] + p[1]) / counts[b]
+                        level_means[a] = (levels[a] - p[2] + q[2]) / counts[a]
+                        level_means[b] = (levels[b] - q[2] + p[2]) / counts[b]
+
+                        candidate = score(rating_means, level_means)
+                        if candidate < current:
+                            current = candidate
+                            groups[a][i], groups[b][j] = q, p
+                            ratings[a] += q[1] - p[1]
+                            ratings[b] += p[1] - q[1]
+                            levels[a] += q[2] - p[2]
+                            levels[b] += p[2] - q[2]
+                            improved = True
+                            break
+
+                    if improved:
+                        break
+
+                if improved:
+                    break
+
+                rating_means[a], rating_means[b] = a_rating, b_rating
+                level_means[a], level_means[b] = a_level, b_level
+
+            if improved:
+                break
+
+    return groups
+
+
+def partition(players, group_size, budget=0.05, exact_max=12):
+    # Split (guid, rating, level) tuples into groups of at most group_size, balancing the group ratings
+    players = list(players)
+    sizes = group_sizes(len(players), group_size)
+    if len(sizes) <= 1:
+        return [[player[0] for player in players]] if len(players) > 0 else []
+
+    start = time.time()
+    deadline = start + budget
+
+    groups = None
+    if len(players) <= exact_max:
+        search = _Search(players, sizes, deadline)
+        groups = search.run()
+        metrics.increment("exact" if search.exhausted else "exact_timeout")
+
+    if groups is None:
+        groups = _improve(_greedy(players, sizes), deadline)
+        metrics.increment("heuristic")
+
+    metrics.timing("partition", time.time() - start)
+    metrics.gauge("spread", spread(groups)[0])
+
+    return [[player[0] for player in group] for group in groups]
+
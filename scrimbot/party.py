@@ -3,7 +3,10 @@
 import logging
 import time
 import uuid
+import threading
 from sleekxmpp.plugins.xep_0045.muc import MUCJoinTimeout, MUCJoinError
+from scrimbot.command import CommandType
+from scrimbot.util import RunningStats
 
 logger = logging.getLogger(__name__)
 
@@ -63,26 +66,132 @@ class Party:
         self.players = set()
         self.join_time = None
 
+        # Presence tracking
+        self._presence = threading.Condition()
+        self.presence_time = None
+
+        # Member stat aggregates
+        self._stats_lock = threading.Lock()
+        self._reset_member_stats()
+
+    def _reset_member_stats(self):
+        with self._stats_lock:
+            self.ratings = RunningStats()
+            self.levels = RunningStats()
+            self._member_stats = {}
+            self._pending_stats = set()
+            self._prefetch = None
+
+    def _member_online(self, user):
+        with self._stats_lock:
+            self._pending_stats.add(user)
+
+            # Give other members a moment to show up, then load them in one batch
+            if self._prefetch is None:
+                self._prefetch = self.parties.scheduler.schedule(self.config.bot.parties.prefetch_delay, self._start_prefetch)
+
+    def _member_offline(self, user):
+        with self._stats_lock:
+            self._pending_stats.discard(user)
+
+            self._drop_member_stats(user)
+
+    def _drop_member_stats(self, user):
+        try:
+            rating, level, loaded = self._member_stats.pop(user)
+        except KeyError:
+            return
+
+        if rating is not None:
+            self.ratings.remove(rating)
+        if level is not None:
+            self.levels.remove(level)
+
+    def _start_prefetch(self):
+        # Don't load on the timer thread
+        thread = threading.Thread(target=self._prefetch_member_stats)
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch_member_stats(self):
+        try:
+            self.load_member_stats()
+        except Exception:
+            logger.exception("Failed to prefetch member stats for party {0}.".format(self.name or self.guid))
+
+    def load_member_stats(self):
+        with self._stats_lock:
+            self._prefetch = None
+            pending = list(self._pending_stats)
+
+        if len(pending) == 0:
+            return
+
+        data = self.parties.stats.get_many(pending, fields=("MatchMaking.Rating", "Progress.Pilot.Level"))
+
+        with self._stats_lock:
+            for stats in data:
+                user = stats["Guid"]
+
+                # Skip members that left while loading
+                if user not in self._pending_stats:
+                    continue
+
+                # Swap out any previous stats for the member
+                self._drop_member_stats(user)
+
+                rating = stats.get("MatchMaking.Rating")
+                level = stats.get("Progress.Pilot.Level")
+                self._member_stats[user] = (rating, level, time.time())
+                if rating is not None:
+                    self.ratings.add(rating)
+                if level is not None:
+                    self.levels.add(level)
+
+                self._pending_stats.discard(user)
+
+            # Members the api had nothing for would otherwise stay pending forever
+            now = time.time()
+            for user in pending:
+                if user in self._pending_stats:
+                    self._drop_member_stats(user)
+                    self._member_stats[user] = (None, None, now)
+                    self._pending_stats.discard(user)
+
+    def member_stats(self):
+        # Reload members whose ratings may have changed since they were loaded
+        cutoff = time.time() - self.config.api.stats.ttl.mmr
+        with self._stats_lock:
+            for user, (rating, level, loaded) in self._member_stats.items():
+                if loaded < cutoff:
+                    self._pending_stats.add(user)
+
+            pending = len(self._pending_stats) > 0
+
+        # Load anyone the prefetch has not gotten to yet
+        if pending:
+            self.load_member_stats()
+
+        with self._stats_lock:
+            return self.ratings.analysis(), self.levels.analysis()
+
     def __register_events(self):
-        self.xmpp.add_event_handler("muc::%s::joined" % self.room_jid, self.__handle_joined)
-        self.xmpp.add_event_handler("muc::%s::left" % self.room_jid, self.__handle_left)
-        self.xmpp.add_event_handler("muc::%s::presence" % self.room_jid, self.__handle_presence)
-        self.xmpp.add_event_handler("muc::%s::message" % self.room_jid, self.__handle_message)
-        self.xmpp.add_event_handler("muc::%s::partymemberdata" % self.room_jid, self.__handle_partymemberdata)
-        self.xmpp.add_event_handler("session_end", self.__handle_session_end)
+        self.xmpp.rooms.register(self.room_jid, {
+            "joined": self.__handle_joined,
+            "left": self.__handle_left,
+            "presence": self.__handle_presence,
+            "message": self.__handle_message,
+            "partymemberdata": self.__handle_partymemberdata
+        }, self.__handle_session_end)
 
     def __unregister_events(self):
-        self.xmpp.del_event_handler("muc::%s::joined" % self.room_jid, self.__handle_joined)
-        self.xmpp.del_event_handler("muc::%s::left" % self.room_jid, self.__handle_left)
-        self.xmpp.del_event_handler("muc::%s::presence" % self.room_jid, self.__handle_presence)
-        self.xmpp.del_event_handler("muc::%s::message" % self.room_jid, self.__handle_message)
-        self.xmpp.del_event_handler("muc::%s::partymemberdata" % self.room_jid, self.__handle_partymemberdata)
-        self.xmpp.del_event_handler("session_end", self.__handle_session_end)
+        self.xmpp.rooms.unregister(self.room_jid)
 
     def __handle_joined(self, presence):
         # Setup party state
         self.joined = True
         self.join_time = time.time()
+        self._presence_seen()
 
         # Trigger joined event
         for handler in self.event_handlers["joined"]:
@@ -93,19 +202,28 @@ class Party:
         self.joined = False
         self.players = set()
         self.join_time = None
+        self._reset_member_stats()
 
         # Trigger left event
         for handler in self.event_handlers["left"]:
             handler()
 
+    def _presence_seen(self):
+        with self._presence:
+            self.presence_time = time.time()
+            self._presence.notify_all()
+
     def __handle_presence(self, presence):
         # Ignore the bot
         if presence["muc"]["jid"].user == self.api.guid:
             return
 
+        self._presence_seen()
+
         if presence["type"] == "unavailable":
             # Remove the player to the list
             self.players.remove(presence["muc"]["jid"].user)
+            self._member_offline(presence["muc"]["jid"].user)
 
             # Trigger offline event
             for handler in self.event_handlers["offline"]:
@@ -113,6 +231,7 @@ class Party:
         elif presence["muc"]["jid"].user not in self.players:
             # Add the player to the list
             self.players.add(presence["muc"]["jid"].user)
+            self._member_online(presence["muc"]["jid"].user)
 
             # Trigger online event
             for handler in self.event_handlers["online"]:
@@ -142,6 +261,7 @@ class Party:
         self.players = set()
         self.join_time = None
         self.active = False
+        self._reset_member_stats()
 
         # Unregister events
         self.__unregister_events()
@@ -248,21 +368,38 @@ class Party:
         # Mark as inactive
         self.active = False
 
+        # Let any queued messages reach the party before we go
+        self.xmpp.flush_messages(CommandType.PARTY, self.room_jid)
+
         # Leave the party
         self.xmpp.plugin["hawken_party"].leave(self.room_jid)
 
         # Unregister events
         self.__unregister_events()
 
+    def wait_settled(self, quiet, limit):
+        # Wait for the burst of presence after joining to die down, so the player list is complete
+        start = time.time()
+        deadline = start + limit
+
+        with self._presence:
+            while True:
+                now = time.time()
+                wait = min((self.presence_time or start) + quiet, deadline) - now
+                if wait <= 0:
+                    return now < deadline
+
+                self._presence.wait(wait)
+
     @joined
     def message(self, message):
-        # Send the message
-        self.xmpp.plugin["hawken_party"].message(self.room_jid, self.xmpp.boundjid, message)
+        # Send the message through the outbound queue, keeping it in order with command replies
+        self.xmpp.send_message(CommandType.PARTY, self.room_jid, message)
 
     @joined
     def invite(self, user):
         # Get the callsign
-        callsign = self.api.get_user_callsign(user)
+        callsign = self.parties.resolver.get_callsign(user)
 
         # Send the invite
         self.xmpp.plugin["hawken_party"].invite(self.room_jid, self.xmpp.boundjid, self.xmpp.format_jid(user), callsign)
@@ -275,7 +412,7 @@ class Party:
             raise ValueError("Cannot kick ourself from a party")
 
         # Get the callsign
-        callsign = self.api.get_user_callsign(user)
+        callsign = self.parties.resolver.get_callsign(user)
 
         # Send the kick
         self.xmpp.plugin["hawken_party"].kick(self.room_jid, callsign)
@@ -302,14 +439,20 @@ class Party:
 
 
 class PartyManager:
-    def __init__(self, config, api, cache, xmpp):
+    def __init__(self, config, api, cache, xmpp, resolver, stats, scheduler):
         self.config = config
         self.api = api
         self.cache = cache
         self.xmpp = xmpp
+        self.resolver = resolver
+        self.stats = stats
+        self.scheduler = scheduler
 
         self.active = {}
 
+        # Register config
+        self.config.register("bot.parties.prefetch_delay", 0.25)
+
     def register(self, party):
         self.active[party.guid] = party
 
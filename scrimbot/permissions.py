@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+from scrimbot.util import jid_user
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +14,11 @@ class PermissionHandler:
         self._permissions = {}
         self._groups = set()
 
+        # Events
+        self.event_handlers = {}
+        for event in ("loaded", "changed"):
+            self.event_handlers[event] = set()
+
         # Register config
         self.config.register("bot.permissions", dict())
 
@@ -39,6 +46,10 @@ class PermissionHandler:
         # Update the perms base on the groups
         self._update_groups()
 
+        # Trigger loaded event
+        for handler in self.event_handlers["loaded"]:
+            handler()
+
     def save(self, commit=False):
         self.config.bot.permissions = self._permissions
 
@@ -63,6 +74,12 @@ class PermissionHandler:
 
         logger.debug("Unregistered group: {0}".format(group))
 
+    def register_event(self, event, handler):
+        self.event_handlers[event].add(handler)
+
+    def unregister_event(self, event, handler):
+        self.event_handlers[event].remove(handler)
+
     def group_list(self):
         return self._permissions
 
@@ -89,6 +106,11 @@ class PermissionHandler:
 
             # Save perms
             self.save(commit=True)
+
+            # Trigger changed event
+            for handler in self.event_handlers["changed"]:
+                handler(user, group)
+
             return True
 
     def user_group_remove(self, user, group):
@@ -106,6 +128,11 @@ class PermissionHandler:
 
             # Save perms
             self.save(commit=True)
+
+            # Trigger changed event
+            for handler in self.event_handlers["changed"]:
+                handler(user, group)
+
             return True
 
     def user_check_group(self, user, group):
@@ -139,3 +166,80 @@ class PermissionHandler:
                 groups.append(group)
 
         return groups
+
+
+class AdmissionList:
+    def __init__(self, config, xmpp, permissions):
+        self.config = config
+        self.xmpp = xmpp
+        self.permissions = permissions
+
+        self._lock = threading.Lock()
+        self._admitted = set()
+        self._whitelisted = None
+
+        # Register events
+        self.permissions.register_event("loaded", self.rebuild)
+        self.permissions.register_event("changed", self._handle_changed)
+
+    def __contains__(self, jid):
+        # Pick up changes to the whitelisted mode
+        if self._whitelisted != self.config.bot.whitelisted:
+            self.rebuild()
+
+        return jid in self._admitted
+
+    def _check(self, jid, blacklist, whitelist):
+        # Never admit the bot itself
+        if jid_user(jid) == self.xmpp.boundjid.user:
+            return False
+
+        # Require the user to be on the roster with a subscription
+        if jid not in self.xmpp.client_roster or self.xmpp.client_roster[jid]["subscription"] == "none":
+            return False
+
+        user = jid_user(jid)
+
+        # Drop blacklisted users, and those not whitelisted in whitelisted mode
+        if user in blacklist:
+            return False
+        if self._whitelisted and user not in whitelist:
+            return False
+
+        return True
+
+    def _lists(self):
+        whitelist = set(self.permissions.group_users("admin") + self.permissions.group_users("whitelist"))
+        blacklist = set(self.permissions.group_users("blacklist"))
+
+        return blacklist, whitelist
+
+    def _handle_changed(self, user, group):
+        if group in ("admin", "whitelist", "blacklist"):
+            self.update(self.xmpp.format_jid(user))
+
+    def handle_roster_update(self, iq):
+        # Update the entries changed by the roster push
+        for jid in iq["roster"]["items"]:
+            self.update(str(jid))
+
+    def handle_changed_subscription(self, presence):
+        self.update(presence["from"].bare)
+
+    def rebuild(self):
+        with self._lock:
+            self._whitelisted = self.config.bot.whitelisted
+
+            blacklist, whitelist = self._lists()
+            self._admitted = {jid for jid in self.xmpp.client_roster if self._check(jid, blacklist, whitelist)}
+
+        logger.debug("Rebuilt admission list: {0} user(s) admitted.".format(len(self._admitted)))
+
+    def update(self, jid):
+        with self._lock:
+            blacklist, whitelist = self._lists()
+
+            if self._check(jid, blacklist, whitelist):
+                self._admitted.add(jid)
+            else:
+                self._admitted.discard(jid)
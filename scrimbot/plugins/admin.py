@@ -2,6 +2,7 @@
 
 import ast
 from scrimbot.command import CommandType
+from scrimbot.metrics import all_metrics
 from scrimbot.plugins.base import BasePlugin
 
 
@@ -25,6 +26,7 @@ class AdminPlugin(BasePlugin):
         self.register_command(CommandType.PM, "isfriend", self.isfriend, permsreq=["admin"])
         self.register_command(CommandType.PM, "friend", self.friend, permsreq=["admin"])
         self.register_command(CommandType.PM, "unfriend", self.unfriend, permsreq=["admin"])
+        self.register_command(CommandType.PM, "metrics", self.metrics, permsreq=["admin"])
 
     def disable(self):
         pass
@@ -49,7 +51,7 @@ class AdminPlugin(BasePlugin):
             return False, "Unknown group '{0}'.".format(group)
 
         # Check callsign
-        guid = self._api.get_user_guid(callsign)
+        guid = self._resolver.get_guid(callsign)
 
         if guid is None:
             return False, "No such user exists."
@@ -109,7 +111,7 @@ class AdminPlugin(BasePlugin):
                     self._xmpp.send_message(cmdtype, target, "No users in group '{0}'.".format(group))
                 else:
                     # Convert user guids to callsigns, where possible.
-                    callsign = self._api.get_user_callsign(group_users)
+                    callsign = self._resolver.get_callsigns(group_users)
                     users = [callsign.get(x, x) for x in group_users]
 
                     # Display the users in the group
@@ -122,7 +124,7 @@ class AdminPlugin(BasePlugin):
         # Check if we have a specific user
         if len(args) > 0:
             callsign = args[0]
-            guid = self._api.get_user_guid(callsign)
+            guid = self._resolver.get_guid(callsign)
 
             if guid is None:
                 self._xmpp.send_message(cmdtype, target, "No such user exists.")
@@ -245,7 +247,7 @@ class AdminPlugin(BasePlugin):
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing callsign.")
         else:
-            guid = self._api.get_user_guid(args[0])
+            guid = self._resolver.get_guid(args[0])
 
             if self._xmpp.has_jid(self._xmpp.format_jid(guid)):
                 self._xmpp.send_message(cmdtype, target, "{0} is a friend of the bot.".format(args[0]))
@@ -257,7 +259,7 @@ class AdminPlugin(BasePlugin):
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing callsign.")
         else:
-            guid = self._api.get_user_guid(args[0])
+            guid = self._resolver.get_guid(args[0])
 
             if self._xmpp.add_jid(self._xmpp.format_jid(guid)):
                 self._xmpp.send_message(cmdtype, target, "Added {0} as a friend.".format(args[0]))
@@ -269,9 +271,21 @@ class AdminPlugin(BasePlugin):
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing callsign.")
         else:
-            guid = self._api.get_user_guid(args[0])
+            guid = self._resolver.get_guid(args[0])
 
             self._xmpp.remove_jid(self._xmpp.format_jid(guid))
             self._xmpp.send_message(cmdtype, target, "Removed {0} as a friend.".format(args[0]))
 
+    def metrics(self, cmdtype, cmdname, args, target, user, party):
+        # Filter the metrics by name, if given
+        if len(args) > 0:
+            targets = [metrics for metrics in all_metrics() if args[0] in metrics.name]
+        else:
+            targets = all_metrics()
+
+        if len(targets) > 0:
+            self._xmpp.send_message(cmdtype, target, "\n".join(metrics.format() for metrics in targets))
+        else:
+            self._xmpp.send_message(cmdtype, target, "No metrics found.")
+
 plugin = AdminPlugin
@@ -16,11 +16,14 @@ class BasePlugin(metaclass=ABCMeta):
         self._cache = client.cache
         self._permissions = client.permissions
         self._api = client.api
+        self._resolver = client.resolver
+        self._stats = client.stats
+        self._servers = client.servers
         self._plugins = client.plugins
         self._commands = client.commands
         self._parties = client.parties
         self._scheduler = client.scheduler
-        self.registered = {"config": set(), "cache": set(), "groups": set(), "commands": {}, "tasks": set()}
+        self.registered = {"config": set(), "cache": set(), "groups": set(), "commands": {}, "tasks": set(), "server_events": set()}
 
     def _thread_name(self, name):
         return "{0}:{1}".format(self.name, name)
@@ -63,6 +66,9 @@ class BasePlugin(metaclass=ABCMeta):
         for task in self.registered["tasks"].copy():
             self.unregister_task(task)
 
+        for event, handler in self.registered["server_events"].copy():
+            self.unregister_server_event(event, handler)
+
     def register_config(self, path, default):
         self._config.register(path, default)
         self.registered["config"].add(path)
@@ -116,6 +122,14 @@ class BasePlugin(metaclass=ABCMeta):
         self._scheduler.remove(self._thread_name(name))
         self.registered["tasks"].remove(name)
 
+    def register_server_event(self, event, handler):
+        self._servers.register_event(event, handler)
+        self.registered["server_events"].add((event, handler))
+
+    def unregister_server_event(self, event, handler):
+        self._servers.unregister_event(event, handler)
+        self.registered["server_events"].remove((event, handler))
+
 
 class PluginManager:
     def __init__(self, client):
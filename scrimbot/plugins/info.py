@@ -110,7 +110,7 @@ Not every bit of information is required, but at the very least you need to send
 
     def whoami(self, cmdtype, cmdname, args, target, user, party):
         # Get the callsign
-        callsign = self._api.get_user_callsign(user)
+        callsign = self._resolver.get_callsign(user)
 
         # Check if we got a callsign back
         if callsign is None:
@@ -131,7 +131,10 @@ Not every bit of information is required, but at the very least you need to send
                 return
 
             # Load the server info by name
-            servers = self._api.get_server_by_name(args[0])
+            servers = self._servers.find_by_name(args[0])
+            if servers is False:
+                self._xmpp.send_message(cmdtype, target, "Error: Failed to load server list.")
+                return
             if len(servers) < 1:
                 self._xmpp.send_message(cmdtype, target, "No such server.")
                 return
@@ -142,13 +145,13 @@ Not every bit of information is required, but at the very least you need to send
             server = servers[0]
         else:
             # Find the server the user is on
-            servers = self._api.get_user_server(user, cache_bypass=True)
-            if servers is None:
+            server = self._servers.user_server(user)
+            if server is None:
                 self._xmpp.send_message(cmdtype, target, "You are not on a server.")
                 return
 
             # Load the server info
-            server = self._api.get_server(servers[0])
+            server = self._servers.get(server)
 
         # Return the server info
         message = "Server {0[ServerName]}: {1} on {2} in {3} - Users {4}/{0[MaxUsers]}".format(server, gametype_names.get(server["GameType"], server["GameType"]), map_names.get(server["Map"], server["Map"]), region_names.get(server["Region"], server["Region"]), len(server["Users"]))
@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import smtplib
-from email.mime.text import MIMEText
 from scrimbot.command import CommandType
 from scrimbot.plugins.base import BasePlugin
 
@@ -33,6 +31,10 @@ class PagerPlugin(BasePlugin):
         pass
 
     def email_page(self, f, t, message):
+        # Import the mail modules on first use to keep plugin loading fast
+        import smtplib
+        from email.mime.text import MIMEText
+
         msg = MIMEText(message)
         msg["Subject"] = "Page from {0}".format(f)
         msg["From"] = self._config.plugins.page.email_from
@@ -49,7 +51,7 @@ class PagerPlugin(BasePlugin):
         else:
             msg_target = args[0].lower()
             message = " ".join(args[1:])
-            f = self._api.get_user_callsign(user) or user
+            f = self._resolver.get_callsign(user) or user
             if msg_target == "ashfire908":
                 if self._config.plugins.page.ashfire908 is None:
                     raise Exception("No page target for ashfire908")
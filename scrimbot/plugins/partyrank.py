@@ -4,7 +4,7 @@ import logging
 import hawkenapi.exceptions
 from scrimbot.command import CommandType
 from scrimbot.plugins.base import BasePlugin
-from scrimbot.util import stat_analysis, get_bracket
+from scrimbot.util import get_bracket
 
 logger = logging.getLogger(__name__)
 
@@ -67,20 +67,18 @@ class PartyRankPlugin(BasePlugin):
             self._xmpp.send_message(cmdtype, target, result[1])
         else:
             try:
-                data = self._api.get_user_stats(list(party.players))
+                mmr_info, pilot_level = party.member_stats()
             except hawkenapi.exceptions.InvalidBatch:
                 self._xmpp.send_message(cmdtype, target, "Error: Failed to load player data.")
             else:
-                mmr_info = stat_analysis(data, "MatchMaking.Rating")
-                pilot_level = stat_analysis(data, "Progress.Pilot.Level")
 
                 if not mmr_info:
                     self._xmpp.send_message(cmdtype, target, "There are no ranked players in the party.")
 
                     # Log it
                     self.record_usage(cmdname, False, party)
-                elif len(mmr_info["list"]) < self._config.plugins.partyrank.min_users and not self._permissions.user_check_group(user, "admin"):
-                    self._xmpp.send_message(cmdtype, target, "There needs to be at least {0} ranked players in the party - only {1} of the players are currently ranked.".format(self._config.plugins.partyrank.min_users, len(mmr_info["list"])))
+                elif mmr_info["count"] < self._config.plugins.partyrank.min_users and not self._permissions.user_check_group(user, "admin"):
+                    self._xmpp.send_message(cmdtype, target, "There needs to be at least {0} ranked players in the party - only {1} of the players are currently ranked.".format(self._config.plugins.partyrank.min_users, mmr_info["count"]))
 
                     # Log it
                     self.record_usage(cmdname, False, party, mmr_info)
@@ -101,19 +99,18 @@ class PartyRankPlugin(BasePlugin):
             self._xmpp.send_message(cmdtype, target, result[1])
         else:
             try:
-                data = self._api.get_user_stats(list(party.players))
+                mmr_info = party.member_stats()[0]
             except hawkenapi.exceptions.InvalidBatch:
                 self._xmpp.send_message(cmdtype, target, "Error: Failed to load player data.")
             else:
-                mmr_info = stat_analysis(data, "MatchMaking.Rating")
 
                 if not mmr_info:
                     self._xmpp.send_message(cmdtype, target, "There are no ranked players in the party.")
 
                     # Log it
                     self.record_usage(cmdname, False, party)
-                elif len(mmr_info["list"]) < self._config.plugins.partyrank.min_users and not self._permissions.user_check_group(user, "admin"):
-                    self._xmpp.send_message(cmdtype, target, "There needs to be at least {0} ranked players in the party - only {1} of the players are currently ranked.".format(self._config.plugins.partyrank.min_users, len(mmr_info["list"])))
+                elif mmr_info["count"] < self._config.plugins.partyrank.min_users and not self._permissions.user_check_group(user, "admin"):
+                    self._xmpp.send_message(cmdtype, target, "There needs to be at least {0} ranked players in the party - only {1} of the players are currently ranked.".format(self._config.plugins.partyrank.min_users, mmr_info["count"]))
 
                     # Log it
                     self.record_usage(cmdname, False, party, mmr_info)
@@ -2,6 +2,7 @@
 
 import time
 import math
+import bisect
 import logging
 from scrimbot.cache import CacheList
 from scrimbot.command import CommandType
@@ -22,6 +23,7 @@ class PlayerRankPlugin(BasePlugin):
         self.register_config("plugins.playerrank.limit.period", 60 * 60 * 2)
         self.register_config("plugins.playerrank.restricted.mmr", False)
         self.register_config("plugins.playerrank.bracket_range", 0)
+        self.register_config("plugins.playerrank.bulk_max", 16)
 
         # Register cache
         self.register_cache("mmr_usage")
@@ -31,6 +33,7 @@ class PlayerRankPlugin(BasePlugin):
 
         # Register commands
         self.register_command(CommandType.PM, "mmr", self.mmr)
+        self.register_command(CommandType.PM, "mmrs", self.mmrs)
         self.register_command(CommandType.PM, "psr", self.psr, hidden=True)
         self.register_command(CommandType.PM, "glicko", self.glicko, hidden=True, safe=True)
         self.register_command(CommandType.PM, "elo", self.elo, hidden=True, safe=True)
@@ -39,10 +42,13 @@ class PlayerRankPlugin(BasePlugin):
         pass
 
     def connected(self):
-        pass
+        # Start usage eviction
+        self.register_task("usage_eviction", self._config.plugins.playerrank.limit.period, self.evict_usage, repeat=True)
 
     def disconnected(self):
-        pass
+        if "usage_eviction" in self.registered["tasks"]:
+            # Stop usage eviction
+            self.unregister_task("usage_eviction")
 
     def limit_active(self, user):
         return self._config.plugins.playerrank.limit.count > 0 and \
@@ -54,31 +60,53 @@ class PlayerRankPlugin(BasePlugin):
 
         self.update_usage(user)
 
+        return self.usage_count(user) >= self._config.plugins.playerrank.limit.count
+
+    def usage_count(self, user):
         try:
-            return len(self._cache["mmr_usage"][user]) >= self._config.plugins.playerrank.limit.count
+            return len(self._cache["mmr_usage"][user])
         except KeyError:
-            return False
+            return 0
 
     def next_check(self, user):
         return math.ceil(self._config.plugins.playerrank.limit.period - (time.time() - self._cache["mmr_usage"][user][0]))
 
     def update_usage(self, user):
         if self.limit_active(user):
-            if user not in self._cache["mmr_usage"]:
+            try:
+                usage = self._cache["mmr_usage"][user]
+            except KeyError:
                 return
 
-            now = time.time()
-            for _time in self._cache["mmr_usage"][user][:]:
-                if _time < now - self._config.plugins.playerrank.limit.period:
-                    self._cache["mmr_usage"][user].remove(_time)
+            # Timestamps are kept in order, so expired ones are always at the front
+            expired = bisect.bisect_left(usage, time.time() - self._config.plugins.playerrank.limit.period)
+            if expired == len(usage):
+                del self._cache["mmr_usage"][user]
+            elif expired > 0:
+                del usage[:expired]
 
     def increment_usage(self, user):
         if self.limit_active(user):
             if user not in self._cache["mmr_usage"]:
                 self._cache["mmr_usage"][user] = CacheList()
 
-            # Increment the usage
-            self._cache["mmr_usage"][user].append(time.time())
+            # Increment the usage, keeping only as many timestamps as the limit can look at
+            usage = self._cache["mmr_usage"][user]
+            usage.append(int(time.time()))
+            overflow = len(usage) - self._config.plugins.playerrank.limit.count
+            if overflow > 0:
+                del usage[:overflow]
+
+    def evict_usage(self):
+        # Drop users who have not made a lookup within the period
+        cutoff = time.time() - self._config.plugins.playerrank.limit.period
+        # Work from a snapshot, commands add and remove users while this runs
+        idle = [user for user, usage in list(self._cache["mmr_usage"].items()) if len(usage) == 0 or usage[-1] < cutoff]
+        for user in idle:
+            self._cache["mmr_usage"].pop(user, None)
+
+        if len(idle) > 0:
+            logger.debug("Evicted mmr usage for {0} idle users.".format(len(idle)))
 
     def mmr(self, cmdtype, cmdname, args, target, user, party):
         # Check if the user can perform a mmr lookup
@@ -90,7 +118,7 @@ class PlayerRankPlugin(BasePlugin):
         else:
             # Determine the requested user
             if len(args) > 0:
-                guid = self._api.get_user_guid(args[0])
+                guid = self._resolver.get_guid(args[0])
             else:
                 guid = user
 
@@ -108,7 +136,7 @@ class PlayerRankPlugin(BasePlugin):
                     return
 
             # Grab the mmr
-            stats = self._api.get_user_stats(guid, cache_bypass=True)
+            stats = self._stats.get(guid, cache_bypass=True)
 
             # Check for player data
             if stats is None:
@@ -138,18 +166,75 @@ class PlayerRankPlugin(BasePlugin):
 
                 if self.limit_active(user):
                     # Add the limit message
-                    message += " (Request {0} out of {1} allowed in the next {2})".format(len(self._cache["mmr_usage"][user]),
+                    message += " (Request {0} out of {1} allowed in the next {2})".format(self.usage_count(user),
                                                                                           self._config.plugins.playerrank.limit.count,
                                                                                           format_dhms(self.next_check(user)))
 
                 self._xmpp.send_message(cmdtype, target, message)
 
+    def format_rating(self, rating):
+        if rating is None:
+            return "unknown"
+
+        if self._config.plugins.playerrank.bracket_range == 0:
+            return "{0:.2f}".format(rating)
+
+        return "{0}-{1}".format(*get_bracket(rating, self._config.plugins.playerrank.bracket_range))
+
+    def mmrs(self, cmdtype, cmdname, args, target, user, party):
+        # Check if the user can perform a mmr lookup
+        if self._config.plugins.playerrank.restricted.mmr and not self._permissions.user_check_groups(user, ("admin", "mmr")):
+            self._xmpp.send_message(cmdtype, target, "Access to looking up a player's MMR is restricted.")
+        elif len(args) == 0:
+            self._xmpp.send_message(cmdtype, target, "Missing target users.")
+        elif len(args) > self._config.plugins.playerrank.bulk_max:
+            self._xmpp.send_message(cmdtype, target, "You can only look up {0} players at a time.".format(self._config.plugins.playerrank.bulk_max))
+        elif self.user_overlimit(user):
+            self._xmpp.send_message(cmdtype, target, "You have reached your limit of MMR lookups. (Next check allowed in {0})".format(format_dhms(self.next_check(user))))
+        elif self.limit_active(user) and self.usage_count(user) + len(args) > self._config.plugins.playerrank.limit.count:
+            self._xmpp.send_message(cmdtype, target, "You only have {0} MMR lookups left.".format(self._config.plugins.playerrank.limit.count - self.usage_count(user)))
+        else:
+            # Resolve all the users at once
+            guids = self._resolver.get_guids(args)
+            missing = [callsign for callsign in args if callsign not in guids]
+
+            # Grab the stats in one batch
+            stats = {entry["Guid"]: entry for entry in self._stats.get_many(set(guids.values()), cache_bypass=True)}
+
+            # Format the table
+            lines = []
+            for callsign in args:
+                try:
+                    entry = stats[guids[callsign]]
+                except KeyError:
+                    continue
+
+                if "MatchMaking.Rating" not in entry:
+                    lines.append("{0}: No MMR yet".format(callsign))
+                else:
+                    lines.append("{0}: {1} seasonal, {2} standard".format(callsign, self.format_rating(entry.get("MatchMaking.Rating.Seasonal")), self.format_rating(entry["MatchMaking.Rating"])))
+
+                # Update the usage
+                self.increment_usage(user)
+
+            if len(missing) > 0:
+                lines.append("No such user: {0}".format(", ".join(missing)))
+            if len(lines) == 0:
+                lines.append("Error: Failed to look up player stats.")
+            elif self.limit_active(user) and self.usage_count(user) > 0:
+                # Add the limit message, unless nothing was looked up
+                lines.append("(Request {0} out of {1} allowed in the next {2})".format(self.usage_count(user),
+                                                                                      self._config.plugins.playerrank.limit.count,
+                                                                                      format_dhms(self.next_check(user))))
+
+            self._xmpp.send_message(cmdtype, target, "\n".join(lines))
+
     def psr(self, cmdtype, cmdname, args, target, user, party):
         # Easter egg
 
         # Get user and 'standard' stats
-        stats = self._api.get_user_stats(user)
-        standard = self._api.get_user_stats(self._api.get_user_guid("Poopslinger"))
+        stats = self._stats.get(user)
+        standard = self._stats.get(self._resolver.get_guid("Poopslinger"))
 
         # Verify
         if stats is None or standard is None:
@@ -4,7 +4,7 @@ import logging
 from scrimbot.api import region_names, gametype_names, get_region, get_gametype
 from scrimbot.command import CommandType
 from scrimbot.plugins.base import BasePlugin
-from scrimbot.util import calc_fitness
+from scrimbot.util import calc_fitness, fitness_fields
 
 logger = logging.getLogger(__name__)
 
@@ -58,8 +58,10 @@ class QualityPlugin(BasePlugin):
             # Check if this user is allowed to pick what server to check
             if self._config.plugins.quality.arbitrary_servers or self._permissions.user_check_group(user, "admin"):
                 # Load the server info by name
-                servers = self._api.get_server_by_name(args[0])
+                servers = self._servers.find_by_name(args[0])
 
+                if servers is False:
+                    return False, "Error: Failed to load server list."
                 if len(servers) < 1:
                     return False, "No such server."
                 if len(servers) > 1:
@@ -70,13 +72,13 @@ class QualityPlugin(BasePlugin):
                 return False, "Rankings for arbitrary servers are disabled."
         else:
             # Find the server the user is on
-            server = self._api.get_user_server(user, cache_bypass=True)
+            server = self._servers.user_server(user)
             # Check if they are actually on a server
             if server is None:
                 return False, "You are not on a server."
             else:
                 # Load the server info
-                server_info = self._api.get_server(server[0])
+                server_info = self._servers.get(server)
 
                 if not server_info:
                     return False, "Error: Failed to load server info."
@@ -122,7 +124,7 @@ class QualityPlugin(BasePlugin):
                 self.record_usage(cmdname, result[0], server_info)
             else:
                 # Load the player data
-                player = self._api.get_user_stats(user)
+                player = self._stats.get(user, fields=fitness_fields)
 
                 if player is None:
                     self._xmpp.send_message(cmdtype, target, "Error: Failed to load player stats.")
@@ -161,7 +163,7 @@ class QualityPlugin(BasePlugin):
                 self.record_usage(cmdname, result[0], server_info)
             else:
                 # Load the player data
-                player = self._api.get_user_stats(user)
+                player = self._stats.get(user, fields=fitness_fields)
 
                 if player is None:
                     self._xmpp.send_message(cmdtype, target, "Error: Failed to load player stats.")
@@ -206,13 +208,15 @@ class QualityPlugin(BasePlugin):
         else:
             gametype = None
 
-        # Get the server list
-        server_list = self._api.get_server_list()
+        # Get the servers in the region
+        snapshot = self._servers.snapshot()
 
         # Load the player data
-        player = self._api.get_user_stats(user)
+        player = self._stats.get(user, fields=fitness_fields)
 
-        if player is None:
+        if snapshot is None:
+            self._xmpp.send_message(cmdtype, target, "Error: Failed to load server list.")
+        elif player is None:
             self._xmpp.send_message(cmdtype, target, "Error: Failed to load player stats.")
         else:
             # Filter the servers and calculate the fitness
@@ -251,7 +255,7 @@ class QualityPlugin(BasePlugin):
 
                 return abs(fitness[0])
 
-            results = sorted((server for server in server_list if server_filter(server)), key=get_fitness)[:self._config.plugins.quality.max_results]
+            results = sorted((server for server in snapshot.in_region(region) if server_filter(server)), key=get_fitness)[:self._config.plugins.quality.max_results]
 
             # Get the header identifier
             if gametype is None:
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import functools
 import threading
 from hawkenapi.exceptions import InvalidResponse
 from hawkenapi.sleekxmpp.party import CancelCode
@@ -24,8 +25,10 @@ class ScrimParty(Party):
         self.reservation = None
         self.countdown = None
         self.state = DeploymentState.IDLE
-        self._thread_timer = None
+        self._deploy_timer = None
         self._thread_deploy = None
+        self._deploy_lock = threading.Lock()
+        self._deploy_waiting = None
 
         # Register events
         self.register_event("joined", self._handle_joined)
@@ -49,13 +52,11 @@ class ScrimParty(Party):
         self.countdown = None
         self.state = DeploymentState.IDLE
 
-        try:
-            if self._thread_timer is not None:
-                self._thread_timer.cancel()
-        except AttributeError:
-            pass
-        self._thread_timer = None
+        if self._deploy_timer is not None:
+            self._deploy_timer.cancel()
+        self._deploy_timer = None
         self._thread_deploy = None
+        self._deploy_waiting = None
 
     def _handle_online(self, presence):
         if self.joined:
@@ -83,9 +84,13 @@ class ScrimParty(Party):
         elif message["partymemberdata"]["infoName"] == MemberDataCodes.travel_request:
             self.state = DeploymentState.DEPLOYED
 
-    def _thread_timer_start(self):
-        self._thread_timer = threading.Timer(self.countdown, self._complete_deployment)
-        self._thread_timer.start()
+    def _deploy_timer_start(self):
+        if self._deploy_waiting is None:
+            callback = self._complete_deployment
+        else:
+            callback = functools.partial(self._deploy_step, self.reservation, "countdown")
+
+        self._deploy_timer = self.parties.scheduler.schedule(self.countdown, callback)
 
     def _thread_deploy_start(self, countdown):
         self._thread_deploy = threading.Thread(target=self._handle_deployment, args=(self._start_deployment, ))
@@ -108,6 +113,41 @@ class ScrimParty(Party):
         # Start the deployment thread
         self._thread_deploy_start(countdown)
 
+    def _start_pipelined(self, reservation, countdown):
+        assert self.state == DeploymentState.IDLE
+        assert self.is_leader
+
+        # Set the reservation, travel waits on both the countdown and the reservation
+        self.reservation = reservation
+        self.countdown = countdown
+        self._deploy_waiting = {"countdown", "ready"}
+
+        # Send the notice
+        self.xmpp.plugin["hawken_party"].matchmaking_start(self.room_jid, self.xmpp.boundjid)
+
+        # Set the state to matchmaking
+        self.state = DeploymentState.MATCHMAKING
+
+        # Start the countdown right away, and poll the reservation alongside it
+        self._start_deployment()
+        self._thread_deploy = threading.Thread(target=self._handle_deployment, args=(functools.partial(self._deploy_step, reservation, "ready"), ))
+        self._thread_deploy.start()
+
+    def _deploy_step(self, reservation, step):
+        with self._deploy_lock:
+            # Ignore steps from a deployment that has since been aborted or replaced
+            if reservation is not self.reservation or self._deploy_waiting is None or self.state != DeploymentState.DEPLOYING:
+                return
+
+            self._deploy_waiting.discard(step)
+            if len(self._deploy_waiting) > 0:
+                return
+
+            self._deploy_waiting = None
+
+            # Deploy while holding the lock, so an abort can't slip in between
+            self._complete_deployment()
+
     def _cancel_matchmaking(self, code):
         assert self.state == DeploymentState.MATCHMAKING
         assert self.is_leader
@@ -126,7 +166,7 @@ class ScrimParty(Party):
         self.xmpp.plugin["hawken_party"].deploy_start(self.room_jid, self.xmpp.boundjid, 10)
 
         # Start deployment timer
-        self._thread_timer_start()
+        self._deploy_timer_start()
 
         # Set the state to deploying
         self.state = DeploymentState.DEPLOYING
@@ -136,8 +176,8 @@ class ScrimParty(Party):
         assert self.is_leader
 
         # Cancel the deployment timer
-        if self._thread_timer is not None:
-            self._thread_timer.cancel()
+        if self._deploy_timer is not None:
+            self._deploy_timer.cancel()
 
         # Send the notice
         self.xmpp.plugin["hawken_party"].deploy_cancel(self.room_jid, self.xmpp.boundjid, code)
@@ -239,7 +279,10 @@ class ScrimParty(Party):
     def deploy(self, reservation, countdown=10):
         # Start the deployment
         if self.state == DeploymentState.IDLE:
-            self._start_matchmaking(reservation, countdown)
+            if self.config.plugins.scrim.pipelined_deploy:
+                self._start_pipelined(reservation, countdown)
+            else:
+                self._start_matchmaking(reservation, countdown)
         elif self.state == DeploymentState.DEPLOYED:
             self._change_server(reservation)
         else:
@@ -249,12 +292,17 @@ class ScrimParty(Party):
     def abort(self, code=CancelCode.none):
         if not self.is_leader:
             return False
-        elif self.state == DeploymentState.MATCHMAKING:
-            self._cancel_matchmaking(code)
-        elif self.state == DeploymentState.DEPLOYING:
-            self._cancel_deployment(code)
-        else:
-            return False
+
+        with self._deploy_lock:
+            if self.state == DeploymentState.MATCHMAKING:
+                self._cancel_matchmaking(code)
+            elif self.state == DeploymentState.DEPLOYING:
+                self._cancel_deployment(code)
+            else:
+                return False
+
+            # Stop any pending deploy step from going through
+            self._deploy_waiting = None
 
         # Cancel the reservation
         self.reservation.cancel()
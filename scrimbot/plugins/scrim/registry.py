@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import functools
+import threading
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+class ScrimRegistry:
+    def __init__(self, config, parties, scheduler, expire):
+        self.config = config
+        self._parties = parties
+        self.scheduler = scheduler
+        self.expire = expire
+
+        self._lock = threading.RLock()
+        self._names = {}
+        self._timers = {}
+        self._handlers = {}
+        self.running = False
+
+        self.reindex()
+
+    @property
+    def parties(self):
+        # Look the parties up every time, the cache may have replaced them since
+        return self._parties()
+
+    def __contains__(self, guid):
+        return guid in self.parties
+
+    def __len__(self):
+        return len(self.parties)
+
+    def add(self, guid, name):
+        with self._lock:
+            if name.lower() in self._names:
+                raise ValueError("Scrim {0} is already registered".format(name))
+
+            self.parties[guid] = {"name": name}
+            self._names[name.lower()] = guid
+
+    def remove(self, guid):
+        with self._lock:
+            self.disarm(guid)
+            self.unwatch(guid)
+
+            try:
+                party = self.parties.pop(guid)
+            except KeyError:
+                return False
+
+            if self._names.get(party["name"].lower()) == guid:
+                del self._names[party["name"].lower()]
+
+            return True
+
+    def name_exists(self, name):
+        return name.lower() in self._names
+
+    def get_guid(self, identifier):
+        # Look for party by guid, then by name
+        identifier = identifier.lower()
+        if identifier in self.parties:
+            return identifier
+
+        return self._names.get(identifier)
+
+    def names(self):
+        return [party["name"] for party in self.parties.values()]
+
+    def reindex(self):
+        # Index the cached parties
+        with self._lock:
+            self._names = {party["name"].lower(): guid for guid, party in self.parties.items()}
+
+    def start(self):
+        with self._lock:
+            self.running = True
+
+            # Cached parties expire unless someone is found in them
+            for guid in list(self.parties):
+                try:
+                    party, handlers = self._handlers[guid]
+                except KeyError:
+                    pass
+                else:
+                    if len(party.players) > 0:
+                        continue
+
+                self.arm(guid)
+
+    def stop(self):
+        # Keep the parties around for the next connection, just stop expiring them
+        with self._lock:
+            self.running = False
+            for guid in list(self._timers):
+                self.disarm(guid)
+
+    def arm(self, guid, ttl=None):
+        if ttl is None:
+            ttl = self.config.plugins.scrim.cleanup_period
+
+        with self._lock:
+            if not self.running or guid not in self.parties:
+                return
+
+            # Push the deadline back, replacing any earlier one
+            self.disarm(guid)
+            self._timers[guid] = self.scheduler.schedule(ttl, self._expire, args=(guid, ))
+            metrics.gauge("armed", len(self._timers))
+
+    def disarm(self, guid):
+        with self._lock:
+            try:
+                timer = self._timers.pop(guid)
+            except KeyError:
+                return
+
+            timer.cancel()
+            metrics.gauge("armed", len(self._timers))
+
+    def _expire(self, guid):
+        with self._lock:
+            if not self.running or self._timers.pop(guid, None) is None:
+                return
+
+        logger.debug("Scrim party {0} expired.".format(guid))
+        metrics.increment("expired")
+        self.expire(guid)
+
+    def watch(self, party):
+        # Follow the party's membership, so it expires once it has been empty for the ttl
+        handlers = {
+            "online": functools.partial(self._handle_online, party),
+            "offline": functools.partial(self._handle_offline, party),
+            "left": functools.partial(self._handle_left, party)
+        }
+
+        with self._lock:
+            self.unwatch(party.guid)
+            self._handlers[party.guid] = (party, handlers)
+
+        for event, handler in handlers.items():
+            party.register_event(event, handler)
+
+        if len(party.players) == 0:
+            self.arm(party.guid)
+        else:
+            self.disarm(party.guid)
+
+    def unwatch(self, guid):
+        with self._lock:
+            try:
+                party, handlers = self._handlers.pop(guid)
+            except KeyError:
+                return
+
+        for event, handler in handlers.items():
+            party.unregister_event(event, handler)
+
+    def _handle_online(self, party, presence):
+        self.disarm(party.guid)
+
+    def _handle_offline(self, party, presence):
+        if len(party.players) == 0:
+            self.arm(party.guid)
+
+    def _handle_left(self, party):
+        # The party is gone, reclaim it once the ttl passes unless we rejoin
+        self.arm(party.guid)
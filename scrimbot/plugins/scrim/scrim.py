@@ -2,16 +2,25 @@
 
 import time
 import logging
+import functools
 import threading
+import concurrent.futures
+import hawkenapi.exceptions
+from hawkenapi.mappings import MatchState
 from hawkenapi.sleekxmpp.party import CancelCode
+from scrimbot.api import get_region, get_gametype
 from scrimbot.cache import CacheDict
 from scrimbot.command import CommandType
+from scrimbot.metrics import get_metrics
+from scrimbot.partition import partition
 from scrimbot.plugins.base import BasePlugin
 from scrimbot.plugins.scrim.party import ScrimParty, DeploymentState
-from scrimbot.reservations import ServerReservation, SynchronizedServerReservation
-from scrimbot.util import jid_user, chunks
+from scrimbot.plugins.scrim.registry import ScrimRegistry
+from scrimbot.reservations import ServerReservation, SynchronizedServerReservation, HedgedServerReservation
+from scrimbot.util import chunks, gen_composite_player, calc_fitness, fitness_fields
 
 logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
 
 
 class ScrimPlugin(BasePlugin):
@@ -23,6 +32,13 @@ class ScrimPlugin(BasePlugin):
         # Register config
         self.register_config("plugins.scrim.cleanup_period", 60 * 15)
         self.register_config("plugins.scrim.max_group_size", 6)
+        self.register_config("plugins.scrim.hedge_servers", 3)
+        self.register_config("plugins.scrim.partition_budget", 0.05)
+        self.register_config("plugins.scrim.pipelined_deploy", True)
+        self.register_config("plugins.scrim.rejoin.workers", 4)
+        self.register_config("plugins.scrim.rejoin.timeout", 60)
+        self.register_config("plugins.scrim.rejoin.settle", 0.5)
+        self.register_config("plugins.scrim.rejoin.settle_max", 5)
 
         # Register cache
         self.register_cache("scrims")
@@ -37,6 +53,7 @@ class ScrimPlugin(BasePlugin):
         self.register_command(CommandType.PARTY, "invite", self.party_invite, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
         self.register_command(CommandType.PARTY, "kick", self.party_kick, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
         self.register_command(CommandType.PARTY, "deploy", self.party_deploy, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
+        self.register_command(CommandType.PARTY, "deployauto", self.party_deploy_auto, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
         self.register_command(CommandType.PARTY, "cancel", self.party_cancel, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
         self.register_command(CommandType.PARTY, "leave", self.party_leave, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
         self.register_command(CommandType.PARTY, "transfer", self.party_transfer, flags=["permsreq", "partyfeat"], permsreq=["admin", "scrim"], partyfeat=["scrim"])
@@ -48,36 +65,96 @@ class ScrimPlugin(BasePlugin):
         if "count" not in self._cache["scrims"]:
             self.count = 1
 
+        self.registry = ScrimRegistry(self._config, lambda: self.parties, self._scheduler, self.expire_party)
+
     def disable(self):
         pass
 
     def connected(self):
-        def rejoin(self, guid, name):
-            party = self._parties.new(ScrimParty, guid, name)
+        # Start expiring parties, indexing whatever the cache loaded
+        self.registry.reindex()
+        self.registry.start()
 
-            if not party.join():
-                # Could not join
-                logger.error("Failed to rejoin party {0}.".format(party.name or party.guid))
-                del self._cache["scrims"]["parties"][guid]
+        # Rejoin parties in the background, so the connection isn't held up
+        thread = threading.Thread(target=self.rehydrate, name="scrim_rehydrate")
+        thread.daemon = True
+        thread.start()
 
-            if len(party.players) < 1:
-                # No one is in the party
-                party.leave()
-                logger.info("No one was in party {0} on rejoin; left party.".format(party.name or party.guid))
-                del self._cache["scrims"]["parties"][guid]
+    def rejoin(self, guid, name):
+        party = self._parties.new(ScrimParty, guid, name)
+
+        if not party.join():
+            # Could not join
+            logger.error("Failed to rejoin party {0}.".format(party.name or party.guid))
+            return "failed"
+
+        # Let the presence of the members already in the party arrive before checking if it's empty
+        if not party.wait_settled(self._config.plugins.scrim.rejoin.settle, self._config.plugins.scrim.rejoin.settle_max):
+            logger.warning("Presence did not settle in party {0} after rejoin.".format(party.name or party.guid))
+
+        if len(party.players) < 1:
+            # No one is in the party
+            party.leave()
+            logger.info("No one was in party {0} on rejoin; left party.".format(party.name or party.guid))
+            return "empty"
+
+        # Track the party's expiry
+        self.registry.watch(party)
+        return "joined"
+
+    def _rejoin_late(self, guid, future):
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("Exception while rejoining party {0}.".format(guid))
+            result = "failed"
+
+        logger.info("Late rejoin of party {0} finished: {1}.".format(guid, result))
+        if result != "joined":
+            self.registry.remove(guid)
+
+    def rehydrate(self):
+        start = time.time()
+        targets = [(guid, party["name"]) for guid, party in list(self.parties.items()) if guid not in self._parties.active]
+        if len(targets) == 0:
+            return
+
+        results = {"joined": [], "failed": [], "empty": [], "timeout": []}
+
+        # Rejoin with a bounded number of workers
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._config.plugins.scrim.rejoin.workers)
+        try:
+            futures = {executor.submit(self.rejoin, guid, name): guid for guid, name in targets}
+            done, pending = concurrent.futures.wait(futures, timeout=self._config.plugins.scrim.rejoin.timeout)
+
+            for future in done:
+                try:
+                    results[future.result()].append(futures[future])
+                except Exception:
+                    logger.exception("Exception while rejoining party {0}.".format(futures[future]))
+                    results["failed"].append(futures[future])
 
-        # Rejoin parties
-        for guid, party in self._cache["scrims"]["parties"].items():
-            if guid not in self._parties.active:
-                threading.Thread(target=rejoin, args=[self, guid, party["name"]]).start()
+            # Leave the stragglers to finish on their own
+            for future in pending:
+                future.add_done_callback(functools.partial(self._rejoin_late, futures[future]))
+                results["timeout"].append(futures[future])
+        finally:
+            executor.shutdown(wait=False)
 
-        # Start cleanup thread
-        self.register_task("cleanup_thread", self._config.plugins.scrim.cleanup_period, self.cleanup_parties, repeat=True)
+        # Drop the dead parties in one go, now that nothing is iterating over them
+        for guid in results["failed"] + results["empty"]:
+            self.registry.remove(guid)
+
+        elapsed = time.time() - start
+        metrics.timing("rehydrate", elapsed)
+        for result, guids in results.items():
+            metrics.increment("rejoin.{0}".format(result), len(guids))
+
+        logger.info("Rejoined {0} of {1} parties in {2:.3f}s ({3} failed, {4} empty, {5} timed out).".format(len(results["joined"]), len(targets), elapsed, len(results["failed"]), len(results["empty"]), len(results["timeout"])))
 
     def disconnected(self):
-        if "cleanup_thread" in self.registered["tasks"]:
-            # Stop cleanup thread
-            self.unregister_task("cleanup_thread")
+        # Stop expiring parties until they are rejoined
+        self.registry.stop()
 
     @property
     def parties(self):
@@ -102,19 +179,10 @@ class ScrimPlugin(BasePlugin):
         return name
 
     def _guid_exists(self, guid):
-        for jid in self._parties.joined_rooms:
-            if jid_user(jid) == guid:
-                return True
-
-        return False
+        return guid in self._parties.active or guid in self.registry
 
     def _name_exists(self, name):
-        name = name.lower()
-        for party in self.parties.values():
-            if party["name"].lower() == name:
-                return True
-
-        return False
+        return self.registry.name_exists(name)
 
     def check_party(self, party):
         if "scrim" not in party.features:
@@ -123,19 +191,8 @@ class ScrimPlugin(BasePlugin):
             return True
 
     def get_party_guid(self, identifier):
-        identifier = identifier.lower()
-
         # Look for party by name or guid
-        for guid, party in self.parties.items():
-            if guid == identifier:
-                # Found party by guid
-                return guid
-            if party["name"].lower() == identifier:
-                # Found party by name
-                return guid
-
-        # The party does not exist
-        return None
+        return self.registry.get_guid(identifier)
 
     def get_party(self, guid):
         try:
@@ -160,8 +217,9 @@ class ScrimPlugin(BasePlugin):
         # Create the party
         party = self._parties.new(ScrimParty, guid, name)
         if party.create():
-            # Add the party to the list
-            self.parties[guid] = {"name": name}
+            # Add the party to the list and track its expiry
+            self.registry.add(guid, name)
+            self.registry.watch(party)
 
             return party
         else:
@@ -179,37 +237,44 @@ class ScrimPlugin(BasePlugin):
         except KeyError:
             pass
 
+        # Purge the party from the list
+        self.registry.remove(guid)
+
+    def expire_party(self, guid):
         try:
-            # Purge the party from the list
-            del self.parties[guid]
+            party = self._parties.active[guid]
         except KeyError:
+            # Party does not actually exist, purge it
             pass
+        else:
+            if len(party.players) > 0:
+                # Someone came back just as the party expired
+                return
 
-    def cleanup_parties(self):
-        time_check = time.time() - self._config.plugins.scrim.cleanup_period
+        logger.debug("Purging expired party {0}.".format(guid))
+        self.leave_party(guid)
 
-        # Check for parties to cleanup
-        targets = []
-        for guid in self.parties:
-            try:
-                party = self._parties.active[guid]
-            except KeyError:
-                # Party does not actually exist, purge it
-                targets.append(guid)
-            else:
-                if len(party.players) == 0 and party.join_time < time_check:
-                    # Party is empty, purge it
-                    targets.append(guid)
+    def split_players(self, players):
+        try:
+            stats = {entry["Guid"]: entry for entry in self._stats.get_many(players, fields=fitness_fields)}
+        except hawkenapi.exceptions.InvalidBatch:
+            # Can't balance without the stats, fall back to a plain split
+            return chunks(players, self._config.plugins.scrim.max_group_size)
+
+        # Players without a rating yet count as average
+        ratings = [entry["MatchMaking.Rating"] for entry in stats.values() if "MatchMaking.Rating" in entry]
+        default = sum(ratings) / len(ratings) if len(ratings) > 0 else 0
+
+        entries = []
+        for guid in players:
+            entry = stats.get(guid, {})
+            entries.append((guid, entry.get("MatchMaking.Rating", default), entry.get("Progress.Pilot.Level", 0)))
 
-        if len(targets) > 0:
-            # Purge all targeted parties
-            logger.debug("Purging {0} empty parties.".format(len(targets)))
-            for guid in targets:
-                self.leave_party(guid)
+        return partition(entries, self._config.plugins.scrim.max_group_size, self._config.plugins.scrim.partition_budget)
 
     def party_list(self, cmdtype, cmdname, args, target, user, party):
-        if len(self.parties) > 0:
-            self._xmpp.send_message(cmdtype, target, "Current scrims: {0}".format(", ".join([v["name"] for v in self.parties.values()])))
+        if len(self.registry) > 0:
+            self._xmpp.send_message(cmdtype, target, "Current scrims: {0}".format(", ".join(self.registry.names())))
         else:
             self._xmpp.send_message(cmdtype, target, "There are no active scrims.")
 
@@ -260,7 +325,7 @@ class ScrimPlugin(BasePlugin):
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing target user.")
         else:
-            target_user = self._api.get_user_guid(args[0])
+            target_user = self._resolver.get_guid(args[0])
 
             # Check if the user exists
             if target_user is None:
@@ -283,7 +348,7 @@ class ScrimPlugin(BasePlugin):
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing target user.")
         else:
-            target_user = self._api.get_user_guid(args[0])
+            target_user = self._resolver.get_guid(args[0])
 
             # Check if the user exists
             if target_user is None:
@@ -296,7 +361,7 @@ class ScrimPlugin(BasePlugin):
                 self._xmpp.send_message(cmdtype, target, "Error: Refusing to kick myself.")
             # Check if the user is in the party
             elif target_user not in party.players:
-                self._xmpp.send_message(cmdtype, target, "{0} is not in the party.".format(self._api.get_user_callsign(target_user)))
+                self._xmpp.send_message(cmdtype, target, "{0} is not in the party.".format(self._resolver.get_callsign(target_user)))
             else:
                 # Kick the player from the party
                 party.kick(target_user)
@@ -309,7 +374,7 @@ class ScrimPlugin(BasePlugin):
         elif not party.is_leader:
             self._xmpp.send_message(cmdtype, target, "Error: I am not the leader of the party.")
         else:
-            servers = self._api.get_server_by_name(args[0])
+            servers = self._servers.find_by_name(args[0])
 
             # Check the given server
             if servers is False:
@@ -324,19 +389,22 @@ class ScrimPlugin(BasePlugin):
             elif len(party.players) > servers[0]["MaxUsers"]:
                 self._xmpp.send_message(cmdtype, target, "Error: The party is too large to fit on the server.")
             else:
+                # Reload the server, the reservation checks need its current state
+                server = self._servers.get(servers[0]["Guid"], fresh=True) or servers[0]
+
                 if len(party.players) > self._config.plugins.scrim.max_group_size:
                     # Create main reservation
-                    reservation = SynchronizedServerReservation(self._config, self._cache, self._api, servers[0])
+                    reservation = SynchronizedServerReservation(self._config, self._cache, self._api, server, stats=self._stats)
 
-                    # Split party into groups
-                    groups = chunks(list(party.players), self._config.plugins.scrim.max_group_size)
+                    # Split party into groups of similar strength
+                    groups = self.split_players(list(party.players))
 
                     # Add each group to the reservation
                     for group in groups:
                         reservation.add(group, None)
                 else:
                     # Setup the reservation
-                    reservation = ServerReservation(self._config, self._cache, self._api, servers[0], list(party.players), party=None)
+                    reservation = ServerReservation(self._config, self._cache, self._api, server, list(party.players), party=None, stats=self._stats)
 
                 # Check for issues
                 critical, issues = reservation.check()
@@ -358,6 +426,103 @@ class ScrimPlugin(BasePlugin):
                     # Cancel the reservation
                     reservation.cancel()
 
+    def party_deploy_auto(self, cmdtype, cmdname, args, target, user, party):
+        # Check the arguments
+        if len(args) < 1:
+            self._xmpp.send_message(cmdtype, target, "Missing target region.")
+            return
+
+        region = get_region(args[0])
+        if not region:
+            self._xmpp.send_message(cmdtype, target, "Error: Invalid target region.")
+            return
+
+        if len(args) > 1:
+            gametype = get_gametype(args[1])
+            if not gametype:
+                self._xmpp.send_message(cmdtype, target, "Error: Invalid gametype.")
+                return
+        else:
+            gametype = None
+
+        # Check if we are the leader
+        if not party.is_leader:
+            self._xmpp.send_message(cmdtype, target, "Error: I am not the leader of the party.")
+        # Check how many users are being deployed
+        elif len(party.players) < 1:
+            self._xmpp.send_message(cmdtype, target, "Error: There are no users in the party to deploy.")
+        elif len(party.players) > self._config.plugins.scrim.max_group_size:
+            self._xmpp.send_message(cmdtype, target, "Error: The party is too large to deploy without a target server.")
+        else:
+            snapshot = self._servers.snapshot()
+            if snapshot is None:
+                self._xmpp.send_message(cmdtype, target, "Error: Failed to load server list.")
+                return
+
+            def server_filter(server):
+                if server["Region"].lower() != region.lower():
+                    # Region does not match
+                    return False
+
+                if gametype is not None and server["GameType"] != gametype:
+                    # Gametype does not match
+                    return False
+
+                if len(server["DeveloperData"]["PasswordHash"]) > 0 or server["DeveloperData"]["bTournament"] == "true":
+                    # Private server
+                    return False
+
+                if server["MaxUsers"] < (len(server["Users"]) + len(party.players)):
+                    # Not enough room
+                    return False
+
+                if int(server["DeveloperData"]["MatchState"]) == MatchState.unavailable:
+                    # Not taking players
+                    return False
+
+                return True
+
+            candidates = [server for server in snapshot.in_region(region) if server_filter(server)]
+
+            # Rank the candidates by the party's fitness
+            try:
+                players = self._stats.get_many(party.players, fields=fitness_fields)
+            except hawkenapi.exceptions.InvalidBatch:
+                pass
+            else:
+                composite = gen_composite_player(players, fitness_fields)
+                candidates.sort(key=lambda server: abs(calc_fitness(self._cache["globals"], composite, server)[0]))
+
+            candidates = candidates[:self._config.plugins.scrim.hedge_servers]
+            if len(candidates) == 0:
+                self._xmpp.send_message(cmdtype, target, "No suitable servers found.")
+                return
+
+            # Setup the reservation on all the candidates
+            reservation = HedgedServerReservation(self._config, self._cache, self._api, candidates, list(party.players), party=None, stats=self._stats)
+
+            # Check for issues
+            critical, issues = reservation.check()
+
+            # Display issues
+            for issue in issues:
+                self._xmpp.send_message(cmdtype, target, issue)
+
+            if critical:
+                return
+
+            self._xmpp.send_message(cmdtype, target, "Deploying to the first available of: {0}".format(", ".join(candidate.server["ServerName"] for candidate in reservation.reservations)))
+
+            # Place the reservation
+            reservation.reserve()
+
+            try:
+                # Deploy the party
+                party.deploy(reservation)
+            except ValueError:
+                # Cancel the reservation
+                reservation.cancel()
+
     def party_cancel(self, cmdtype, cmdname, args, target, user, party):
         # Check if we are the leader
         if not party.is_leader:
@@ -378,7 +543,7 @@ class ScrimPlugin(BasePlugin):
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing target user.")
         else:
-            target_user = self._api.get_user_guid(args[0])
+            target_user = self._resolver.get_guid(args[0])
 
             # Check if the user exists
             if target_user is None:
@@ -390,7 +555,8 @@ class ScrimPlugin(BasePlugin):
             elif not party.is_leader:
                 self._xmpp.send_message(cmdtype, target, "Error: I am not the leader of the party.")
             else:
-                self._xmpp.send_message(cmdtype, target, "Transfering control over to {0}. Have a nice day.".format(self._api.get_user_callsign(target_user)))
+                self._xmpp.send_message(cmdtype, target, "Transfering control over to {0}. Have a nice day.".format(self._resolver.get_callsign(target_user)))
+                self._xmpp.flush_messages(cmdtype, target)
 
                 party.set_leader(target_user)
                 self.leave_party(party.guid)
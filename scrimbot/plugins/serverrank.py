@@ -1,16 +1,49 @@
 # -*- coding: utf-8 -*-
 
 import math
+import time
 import logging
+import threading
 import hawkenapi.exceptions
 from scrimbot.command import CommandType
 from scrimbot.plugins.base import BasePlugin
-from scrimbot.util import stat_analysis, get_bracket
+from scrimbot.util import get_bracket, RunningStats
 
 
 logger = logging.getLogger(__name__)
 
 
+class ServerAggregate:
+    def __init__(self, users=()):
+        self.stats = RunningStats()
+        self.ratings = {}
+        self.loaded = {}
+        self.pending = set(users)
+
+    def set_rating(self, user, rating, loaded):
+        # Swap out the user's old rating, unranked users are tracked but not counted
+        previous = self.ratings.get(user)
+        if previous is not None:
+            self.stats.remove(previous)
+
+        self.ratings[user] = rating
+        self.loaded[user] = loaded
+        if rating is not None:
+            self.stats.add(rating)
+
+    def remove(self, user):
+        self.pending.discard(user)
+
+        self.loaded.pop(user, None)
+        rating = self.ratings.pop(user, None)
+        if rating is not None:
+            self.stats.remove(rating)
+
+    def requeue_stale(self, cutoff):
+        # Players that stay on the server still need their ratings refreshed now and then
+        self.pending.update(user for user, loaded in self.loaded.items() if loaded < cutoff)
+
+
 class ServerRankPlugin(BasePlugin):
     @property
     def name(self):
@@ -28,6 +61,14 @@ class ServerRankPlugin(BasePlugin):
         self.register_command(CommandType.ALL, "serverrank", self.server_rank, alias=["sr"])
         self.register_command(CommandType.ALL, "serverrankdetailed", self.server_rank_detailed, alias=["srd"])
 
+        # Keep running MMR aggregates for each server
+        self._aggregates = {}
+        self._aggregates_lock = threading.Lock()
+        self.register_server_event("joined", self.handle_joined)
+        self.register_server_event("left", self.handle_left)
+        self.register_server_event("removed", self.handle_removed)
+        self.register_server_event("ranking", self.handle_ranking)
+
     def disable(self):
         pass
 
@@ -37,6 +78,57 @@ class ServerRankPlugin(BasePlugin):
     def disconnected(self):
         pass
 
+    def handle_joined(self, server, users):
+        with self._aggregates_lock:
+            aggregate = self._aggregates.get(server["Guid"])
+            if aggregate is not None:
+                # The stats are loaded the next time the server is looked at
+                aggregate.pending.update(users)
+
+    def handle_left(self, server, users):
+        with self._aggregates_lock:
+            aggregate = self._aggregates.get(server["Guid"])
+            if aggregate is not None:
+                for user in users:
+                    aggregate.remove(user)
+
+    def handle_removed(self, server):
+        with self._aggregates_lock:
+            self._aggregates.pop(server["Guid"], None)
+
+    def handle_ranking(self, server, previous):
+        # The server's ratings moved, so reload the players' ratings on the next lookup
+        with self._aggregates_lock:
+            aggregate = self._aggregates.get(server["Guid"])
+            if aggregate is not None:
+                aggregate.pending.update(aggregate.ratings.keys())
+
+    def server_mmr(self, server_info):
+        with self._aggregates_lock:
+            try:
+                aggregate = self._aggregates[server_info["Guid"]]
+            except KeyError:
+                # Start tracking the server
+                aggregate = ServerAggregate(server_info["Users"])
+                self._aggregates[server_info["Guid"]] = aggregate
+
+            aggregate.requeue_stale(time.time() - self._config.api.stats.ttl.mmr)
+            pending = list(aggregate.pending)
+
+        # Only load the players that changed since the last lookup
+        if len(pending) > 0:
+            data = self._stats.get_many(pending, fields=("MatchMaking.Rating", ))
+            loaded = time.time()
+
+            with self._aggregates_lock:
+                for stats in data:
+                    if stats["Guid"] in aggregate.pending:
+                        aggregate.set_rating(stats["Guid"], stats.get("MatchMaking.Rating"), loaded)
+                        aggregate.pending.discard(stats["Guid"])
+
+        with self._aggregates_lock:
+            return aggregate.stats.analysis()
+
     def record_usage(self, command, returned, server_info, data=None):
         if self._config.plugins.serverrank.log_usage:
             if returned:
@@ -58,8 +150,10 @@ class ServerRankPlugin(BasePlugin):
             # Check if this user is allowed to pick what server to check
             if self._config.plugins.serverrank.arbitrary_servers or self._permissions.user_check_group(user, "admin"):
                 # Load the server info by name
-                servers = self._api.get_server_by_name(args[0])
+                servers = self._servers.find_by_name(args[0])
 
+                if servers is False:
+                    return False, "Error: Failed to load server list."
                 if len(servers) < 1:
                     return False, "No such server."
                 if len(servers) > 1:
@@ -70,14 +164,14 @@ class ServerRankPlugin(BasePlugin):
                 return False, "Rankings for arbitrary servers are disabled."
         else:
             # Find the server the user is on
-            server = self._api.get_user_server(user, cache_bypass=True)
+            server = self._servers.user_server(user)
 
             # Check if they are actually on a server
             if server is None:
                 return False, "You are not on a server."
             else:
                 # Load the server info
-                server_info = self._api.get_server(server[0])
+                server_info = self._servers.get(server)
 
                 if not server_info:
                     return False, "Error: Failed to load server info."
@@ -148,12 +242,10 @@ class ServerRankPlugin(BasePlugin):
             else:
                 # Load the MMR for all the players on the server
                 try:
-                    data = self._api.get_user_stats(server_info["Users"])
+                    mmr_info = self.server_mmr(server_info)
                 except hawkenapi.exceptions.InvalidBatch:
                     self._xmpp.send_message(cmdtype, target, "Error: Failed to load player data.")
                 else:
-                    # Process stats
-                    mmr_info = stat_analysis(data, "MatchMaking.Rating")
 
                     # Check if we have enough players
                     min_users = self.min_users(server_info)
@@ -163,8 +255,8 @@ class ServerRankPlugin(BasePlugin):
 
                         # Log it
                         self.record_usage(cmdname, False, server_info)
-                    elif len(mmr_info["list"]) < min_users and not self._permissions.user_check_group(user, "admin"):
-                        self._xmpp.send_message(cmdtype, target, "There needs to be at least {0} ranked players on the server - only {1} of the players are currently ranked.".format(min_users, len(mmr_info["list"])))
+                    elif mmr_info["count"] < min_users and not self._permissions.user_check_group(user, "admin"):
+                        self._xmpp.send_message(cmdtype, target, "There needs to be at least {0} ranked players on the server - only {1} of the players are currently ranked.".format(min_users, mmr_info["count"]))
 
                         # Log it
                         self.record_usage(cmdname, False, server_info, mmr_info)
@@ -182,7 +274,7 @@ class ServerRankPlugin(BasePlugin):
                             minmax = ""
 
                         if math.floor(mmr_info["mean"]) != server_info["ServerRanking"]:
-                            warn = " (Server is reporting an average of {0})".format(server_info["ServerRanking"])
+                            warn = " (Server is reporting an average of {0}, off by {1:+.2f})".format(server_info["ServerRanking"], server_info["ServerRanking"] - mmr_info["mean"])
                         else:
                             warn = ""
 
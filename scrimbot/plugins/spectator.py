@@ -3,9 +3,11 @@
 import logging
 import threading
 from hawkenapi.exceptions import InvalidResponse
+from scrimbot.cache import CacheList
 from scrimbot.command import CommandType
 from scrimbot.plugins.base import BasePlugin
-from scrimbot.reservations import ReservationResult, ServerReservation, NoSuchServer
+from scrimbot.reservations import ReservationResult, ServerReservation, SynchronizedServerReservation, NoSuchServer
+from scrimbot.util import chunks
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +18,15 @@ class SpectatorPlugin(BasePlugin):
         return "spectator"
 
     def enable(self):
+        # Register config
+        self.register_config("plugins.spectator.watch_max", 10)
+        self.register_config("plugins.spectator.group_window", 5)
+        self.register_config("plugins.spectator.max_group_size", 6)
+
         # Register cache
         self.register_cache("spectators")
+        self.register_cache("spectator_watch")
+        self.register_cache("spectator_autowatch")
 
         # Register group
         self.register_group("spectator")
@@ -30,17 +39,37 @@ class SpectatorPlugin(BasePlugin):
         self.register_command(CommandType.PM, "save", self.save, permsreq=["admin", "spectator"])
         self.register_command(CommandType.PM, "renew", self.renew, permsreq=["admin", "spectator"])
         self.register_command(CommandType.PM, "clear", self.clear, permsreq=["admin", "spectator"])
+        self.register_command(CommandType.PM, "watch", self.watch, permsreq=["admin", "spectator"])
+        self.register_command(CommandType.PM, "unwatch", self.unwatch, permsreq=["admin", "spectator"])
+        self.register_command(CommandType.PM, "autowatch", self.autowatch, permsreq=["admin", "spectator"])
 
         # Setup reservation tracking
         self.reservations = {}
+        self.reservation_users = {}
+        self._reservation_lock = threading.Lock()
+
+        # Setup group renewal tracking
+        self.renew_groups = {}
+        self._renew_lock = threading.Lock()
+
+        # Index the watchlists by watched player
+        self.watchers = {}
+        self.watchers_reindex()
 
     def disable(self):
         pass
 
     def connected(self):
-        pass
+        # The cache is loaded after the plugins are enabled, index what it loaded
+        self.watchers_reindex()
+
+        # Watch for players joining servers
+        self.register_server_event("joined", self.watch_joined)
 
     def disconnected(self):
+        if ("joined", self.watch_joined) in self.registered["server_events"]:
+            self.unregister_server_event("joined", self.watch_joined)
+
         # Delete all pending reservations
         for user in self.reservations:
             self.reservation_delete(user)
@@ -61,13 +90,25 @@ class SpectatorPlugin(BasePlugin):
         # Clear the previous reservation
         self.reservation_delete(user)
 
-        self.reservations[user] = reservation
+        with self._reservation_lock:
+            self.reservations[user] = reservation
+            self.reservation_users.setdefault(reservation, set()).add(user)
 
     def reservation_delete(self, user):
         reservation = self.reservation_get(user)
         if reservation and reservation.created:
+            with self._reservation_lock:
+                self.reservations[user] = None
+
+                # Shared reservations are only canceled once the last user lets go of them
+                users = self.reservation_users.get(reservation, set())
+                users.discard(user)
+                if len(users) > 0:
+                    return True
+
+                self.reservation_users.pop(reservation, None)
+
             reservation.cancel()
-            self.reservations[user] = None
             return True
 
         return False
@@ -94,71 +135,188 @@ class SpectatorPlugin(BasePlugin):
         except KeyError:
             pass
 
+    def watchlist_get(self, user):
+        try:
+            return self._cache["spectator_watch"][user]
+        except KeyError:
+            return []
+
+    def watchers_reindex(self):
+        watchers = {}
+        for user, players in self._cache["spectator_watch"].items():
+            for player in players:
+                watchers.setdefault(player, set()).add(user)
+
+        self.watchers = watchers
+
+    def watchlist_add(self, user, player):
+        if user not in self._cache["spectator_watch"]:
+            self._cache["spectator_watch"][user] = CacheList()
+
+        self._cache["spectator_watch"][user].append(player)
+        self.watchers.setdefault(player, set()).add(user)
+
+    def watchlist_remove(self, user, player):
+        self._cache["spectator_watch"][user].remove(player)
+        if len(self._cache["spectator_watch"][user]) == 0:
+            del self._cache["spectator_watch"][user]
+
+        watchers = self.watchers.get(player)
+        if watchers is not None:
+            watchers.discard(user)
+            if len(watchers) == 0:
+                self.watchers.pop(player, None)
+
+    def watch_joined(self, server, users):
+        # Only look at players someone is watching, so the cost follows the watched players rather than the spectators
+        for player in users:
+            watchers = self.watchers.get(player)
+            if watchers is None:
+                continue
+            watchers = list(watchers)
+
+            callsign = self._resolver.get_callsign(player) or player
+            for user in watchers:
+                target = "{0}@{1}".format(user, self._xmpp.boundjid.host)
+                if self._cache["spectator_autowatch"].get(user, False) and not self.reservation_get(user):
+                    logger.info("Placing reservation for {0} by watch: Server {1}".format(user, server["Guid"]))
+                    self._xmpp.send_message(CommandType.PM, target, "{0} joined server '{1}'. Placing server reservation, waiting for response... use '{2}{3} cancel' to abort.".format(callsign, server["ServerName"], self._config.bot.command_prefix, self.name))
+
+                    # Place the reservation in another thread, so the server list refresh isn't held up
+                    threading.Thread(target=self.place_reservation, args=(CommandType.PM, target, user, server["Guid"])).start()
+                else:
+                    self._xmpp.send_message(CommandType.PM, target, "{0} joined server '{1}'. Use '{2}{3} user {0}' to spectate.".format(callsign, server["ServerName"], self._config.bot.command_prefix, self.name))
+
     def place_reservation(self, cmdtype, target, user, server):
-        # Set up the reservation
+        self.place_shared_reservation([(cmdtype, target, user)], server)
+
+    def place_shared_reservation(self, members, server):
+        users = [user for cmdtype, target, user in members]
+        names = ", ".join(users)
+
+        def notify(message):
+            for cmdtype, target, user in members:
+                self._xmpp.send_message(cmdtype, target, message)
+
+        # Set up the reservation, synchronizing it if the group is too large for one advertisement
         try:
-            reservation = ServerReservation(self._config, self._cache, self._api, server, [user])
+            if len(users) > self._config.plugins.spectator.max_group_size:
+                reservation = SynchronizedServerReservation(self._config, self._cache, self._api, server, stats=self._stats)
+                for group in chunks(users, self._config.plugins.spectator.max_group_size):
+                    reservation.add(group)
+            else:
+                reservation = ServerReservation(self._config, self._cache, self._api, server, users, stats=self._stats)
         except NoSuchServer:
             if isinstance(server, str):
-                logger.warning("Reservation for {0}: Cannot find server {1} - reservation not created".format(user, server))
+                logger.warning("Reservation for {0}: Cannot find server {1} - reservation not created".format(names, server))
             else:
-                logger.warning("Reservation for {0}: Cannot find server {1} [{2}] with match id {3} - reservation not created".format(user, server["Guid"], server["ServerName"], server["MatchId"]))
-            self._xmpp.send_message(cmdtype, target, "Error: Unable to initialize reservation - the requested server does not exist.")
+                logger.warning("Reservation for {0}: Cannot find server {1} [{2}] with match id {3} - reservation not created".format(names, server["Guid"], server["ServerName"], server["MatchId"]))
+            notify("Error: Unable to initialize reservation - the requested server does not exist.")
             return
 
         # Check for potential issues and report them
         critical, issues = reservation.check()
         for issue in issues:
-            self._xmpp.send_message(cmdtype, target, issue)
+            notify(issue)
 
         if critical:
-            logger.info("Reservation for {0}: Check failed critically for server {1} [{2}] with match id {3} - reservation not created".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+            logger.info("Reservation for {0}: Check failed critically for server {1} [{2}] with match id {3} - reservation not created".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
             return
 
         # Submit the reservation
         reservation.reserve()
-        logger.info("Reservation for {0}: Created for server {1} [{2}] with match id {3}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
-        self.reservation_set(user, reservation)
+        logger.info("Reservation for {0}: Created for server {1} [{2}] with match id {3}".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+        for user in users:
+            self.reservation_set(user, reservation)
 
-        # Set up the polling in another thread
-        reservation_thread = threading.Thread(target=self.poll_reservation, args=(cmdtype, target, user))
+        # Set up the polling in another thread, shared by everyone on the reservation
+        reservation_thread = threading.Thread(target=self.poll_shared_reservation, args=(reservation, members))
         reservation_thread.start()
 
-    def poll_reservation(self, cmdtype, target, user):
-        # Get the reservation
-        reservation = self.reservation_get(user)
+    def advertisement_get(self, reservation, user):
+        # Synchronized reservations have an advertisement per group
+        try:
+            groups = reservation.user_groups
+        except AttributeError:
+            return reservation.advertisement
+
+        for group, group_reservation in zip(groups, reservation.reservations):
+            if user in group:
+                return group_reservation.advertisement
+
+        return None
+
+    def poll_shared_reservation(self, reservation, members):
+        names = ", ".join(user for cmdtype, target, user in members)
+
+        def notify(message):
+            for cmdtype, target, user in members:
+                self._xmpp.send_message(cmdtype, target, message)
+
+        def delete():
+            for cmdtype, target, user in members:
+                if self.reservation_get(user) is reservation:
+                    self.reservation_delete(user)
 
         # Poll the reservation
         try:
             result = reservation.poll()
         except InvalidResponse as e:
-            logger.exception("Reservation for {0}: Invalid response for server {1} [{2}] with match id {3}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
-            self.reservation_delete(user)
-            self._xmpp.send_message(cmdtype, target, "Error: Reservation returned invalid response - {0}.".format(e))
+            logger.exception("Reservation for {0}: Invalid response for server {1} [{2}] with match id {3}".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+            delete()
+            notify("Error: Reservation returned invalid response - {0}.".format(e))
         except:
-            logger.exception("Reservation for {0}: Polling failed for server {1} [{2}] with match id {3}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
-            self.reservation_delete(user)
-            self._xmpp.send_message(cmdtype, target, "Error: Failed to poll for reservation. This is a bug - please report it!")
+            logger.exception("Reservation for {0}: Polling failed for server {1} [{2}] with match id {3}".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+            delete()
+            notify("Error: Failed to poll for reservation. This is a bug - please report it!")
         else:
             # Handle the result
             if result == ReservationResult.READY:
-                logger.info("Reservation for {0}: Reservation complete for server {1} [{2}] with match id {3} - Server address {4}:{5}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"], reservation.advertisement["AssignedServerIp"], reservation.advertisement["AssignedServerPort"]))
                 if reservation.server["DeveloperData"]["PasswordHash"] == "":
                     message = "\nReservation for server '{2}' complete.\nServer IP: {0}:{1}\nCommand: openip {0}:{1}?spectatorOnly=1\n\nUse '{3}{4} confirm' after joining the server, or '{3}{4} cancel' if you do not plan on joining the server."
                 else:
                     message = "\nReservation for server '{2}' complete.\nServer IP: {0}:{1}\nCommand: openip {0}:{1}?spectatorOnly=1?password=\nPassword is required to join the server\n\nUse '{3}{4} confirm' after joining the server, or '{3}{4} cancel' if you do not plan on joining the server."
-                self._xmpp.send_message(cmdtype, target, message.format(reservation.advertisement["AssignedServerIp"], reservation.advertisement["AssignedServerPort"], reservation.server["ServerName"], self._config.bot.command_prefix, self.name))
+                for cmdtype, target, user in members:
+                    advertisement = self.advertisement_get(reservation, user)
+                    logger.info("Reservation for {0}: Reservation complete for server {1} [{2}] with match id {3} - Server address {4}:{5}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"], advertisement["AssignedServerIp"], advertisement["AssignedServerPort"]))
+                    self._xmpp.send_message(cmdtype, target, message.format(advertisement["AssignedServerIp"], advertisement["AssignedServerPort"], reservation.server["ServerName"], self._config.bot.command_prefix, self.name))
             else:
-                self.reservation_delete(user)
+                delete()
                 if result == ReservationResult.TIMEOUT:
-                    logger.info("Reservation for {0}: Reservation timeout for server {1} [{2}] with match id {3}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
-                    self._xmpp.send_message(cmdtype, target, "Time limit reached - reservation canceled.")
+                    logger.info("Reservation for {0}: Reservation timeout for server {1} [{2}] with match id {3}".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+                    notify("Time limit reached - reservation canceled.")
                 elif result == ReservationResult.NOTFOUND:
-                    logger.error("Reservation for {0}: Reservation missing for server {1} [{2}] with match id {3}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
-                    self._xmpp.send_message(cmdtype, target, "Error: Could not retrieve advertisement - expired? This is a bug - please report it!")
+                    logger.error("Reservation for {0}: Reservation missing for server {1} [{2}] with match id {3}".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+                    notify("Error: Could not retrieve advertisement - expired? This is a bug - please report it!")
                 elif result == ReservationResult.ERROR:
-                    logger.info("Reservation for {0}: Reservation error for server {1} [{2}] with match id {3}".format(user, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
-                    self._xmpp.send_message(cmdtype, target, "Error: Failed to poll for reservation. This is a bug - please report it!")
+                    logger.info("Reservation for {0}: Reservation error for server {1} [{2}] with match id {3}".format(names, reservation.server["Guid"], reservation.server["ServerName"], reservation.server["MatchId"]))
+                    notify("Error: Failed to poll for reservation. This is a bug - please report it!")
+
+    def renew_group_join(self, cmdtype, target, user, server):
+        with self._renew_lock:
+            # The first spectator for a server opens the window
+            if server not in self.renew_groups:
+                self.renew_groups[server] = []
+                self._scheduler.schedule(self._config.plugins.spectator.group_window, self.renew_group_start, args=(server, ))
+
+            members = self.renew_groups[server]
+            if any(member[2] == user for member in members):
+                return False
+
+            members.append((cmdtype, target, user))
+
+        return True
+
+    def renew_group_start(self, server):
+        # Place the reservation in another thread, so the timer thread isn't held up
+        threading.Thread(target=self.renew_group_place, args=(server, )).start()
+
+    def renew_group_place(self, server):
+        with self._renew_lock:
+            members = self.renew_groups.pop(server)
+
+        logger.info("Placing reservation for {0} by group renewal: Server {1}".format(", ".join(member[2] for member in members), server))
+        self.place_shared_reservation(members, server)
 
     def cancel(self, cmdtype, cmdname, args, target, user, party):
         # Delete the user's server reservation
@@ -178,7 +336,7 @@ class SpectatorPlugin(BasePlugin):
         else:
             logger.info("Confirmed reservation for {0}".format(user))
             # Save the assigned server for later use
-            self.saved_server_set(user, reservation.advertisement["AssignedServerGuid"])
+            self.saved_server_set(user, self.advertisement_get(reservation, user)["AssignedServerGuid"])
             self._xmpp.send_message(cmdtype, target, "Reservation confirmed; saved for future use.")
 
             # Delete the server reservation (as it's fulfilled now)
@@ -190,14 +348,14 @@ class SpectatorPlugin(BasePlugin):
             self._xmpp.send_message(cmdtype, target, "Error: You cannot save a server while joining another.")
         else:
             # Get the user's current server
-            server = self._api.get_user_server(user)
+            server = self._servers.user_server(user)
 
             # Check if they are actually on a server
             if server is None:
                 self._xmpp.send_message(cmdtype, target, "You are not on a server.")
             else:
                 logger.info("Saved reservation for {0}: Server {1}".format(user, server))
-                self.saved_server_set(user, server[0])
+                self.saved_server_set(user, server)
                 self._xmpp.send_message(cmdtype, target, "Current server saved for future use.")
 
     def clear(self, cmdtype, cmdname, args, target, user, party):
@@ -218,41 +376,94 @@ class SpectatorPlugin(BasePlugin):
             # Check if the server exists
             if server is None:
                 self._xmpp.send_message(cmdtype, target, "Error: Could not find the server from your last reservation.")
+            elif len(args) > 0 and args[0].lower() == "group":
+                # Wait for the rest of the group to renew for the same server
+                if self.renew_group_join(cmdtype, target, user, server):
+                    logger.info("Joined group renewal for {0}: Server {1}".format(user, server))
+                    self._xmpp.send_message(cmdtype, target, "Joined group renewal, placing the reservation shortly... use '{0}{1} cancel' to abort once it is placed.".format(self._config.bot.command_prefix, self.name))
+                else:
+                    self._xmpp.send_message(cmdtype, target, "You have already joined the group renewal for this server.")
             else:
                 logger.info("Placing reservation for {0} by renewal: Server {1}".format(user, server))
                 # Place the reservation
                 self._xmpp.send_message(cmdtype, target, "Renewing server reservation, waiting for response... use '{0}{1} cancel' to abort.".format(self._config.bot.command_prefix, self.name))
                 self.place_reservation(cmdtype, target, user, server)
 
+    def watch(self, cmdtype, cmdname, args, target, user, party):
+        # List the watchlist if no players were given
+        if len(args) < 1:
+            watchlist = self.watchlist_get(user)
+            if len(watchlist) == 0:
+                self._xmpp.send_message(cmdtype, target, "You are not watching any players.")
+            else:
+                callsigns = self._resolver.get_callsigns(watchlist)
+                self._xmpp.send_message(cmdtype, target, "Watching: {0}".format(", ".join(sorted(callsigns.get(player, player) for player in watchlist))))
+            return
+
+        # Resolve all the players at once
+        guids = self._resolver.get_guids(args)
+        for callsign in args:
+            guid = guids.get(callsign)
+            if guid is None:
+                self._xmpp.send_message(cmdtype, target, "No such player exists: {0}".format(callsign))
+            elif guid in self.watchlist_get(user):
+                self._xmpp.send_message(cmdtype, target, "Already watching {0}.".format(callsign))
+            elif len(self.watchlist_get(user)) >= self._config.plugins.spectator.watch_max:
+                self._xmpp.send_message(cmdtype, target, "Error: You can only watch {0} players at a time.".format(self._config.plugins.spectator.watch_max))
+                break
+            else:
+                logger.info("Watch for {0}: Added {1}".format(user, guid))
+                self.watchlist_add(user, guid)
+                self._xmpp.send_message(cmdtype, target, "Now watching {0}.".format(callsign))
+
+    def unwatch(self, cmdtype, cmdname, args, target, user, party):
+        # Check arguments
+        if len(args) < 1:
+            self._xmpp.send_message(cmdtype, target, "Missing target user")
+        else:
+            guids = self._resolver.get_guids(args)
+            for callsign in args:
+                guid = guids.get(callsign)
+                if guid is None or guid not in self.watchlist_get(user):
+                    self._xmpp.send_message(cmdtype, target, "You are not watching {0}.".format(callsign))
+                else:
+                    logger.info("Watch for {0}: Removed {1}".format(user, guid))
+                    self.watchlist_remove(user, guid)
+                    self._xmpp.send_message(cmdtype, target, "Stopped watching {0}.".format(callsign))
+
+    def autowatch(self, cmdtype, cmdname, args, target, user, party):
+        # Toggle automatic reservations for watched players
+        enabled = not self._cache["spectator_autowatch"].get(user, False)
+        self._cache["spectator_autowatch"][user] = enabled
+
+        if enabled:
+            self._xmpp.send_message(cmdtype, target, "A reservation will now be placed automatically when a watched player joins a server.")
+        else:
+            self._xmpp.send_message(cmdtype, target, "You will now only be notified when a watched player joins a server.")
+
     def user(self, cmdtype, cmdname, args, target, user, party):
         # Check arguments
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Missing target user")
         else:
             # Get the user
-            guid = self._api.get_user_guid(args[0])
+            guid = self._resolver.get_guid(args[0])
 
             # Check if the user exists
             if guid is None:
                 self._xmpp.send_message(cmdtype, target, "No such player exists.")
             else:
                 # Get the user's server
-                servers = self._api.get_user_server(guid, cache_bypass=True)
+                server = self._servers.user_server(guid)
 
                 # Check if the user is on a server
-                if servers is None:
-                    self._xmpp.send_message(cmdtype, target, "{0} is not on a server.".format(self._api.get_user_callsign(guid)))
+                if server is None:
+                    self._xmpp.send_message(cmdtype, target, "{0} is not on a server.".format(self._resolver.get_callsign(guid)))
                 else:
-                    server = servers[0]
-
-                    # Check if the server exists
-                    if server is None:
-                        self._xmpp.send_message(cmdtype, target, "Error: Could not the find the server '{0}' is on.".format(self._api.get_user_callsign(guid)))
-                    else:
-                        # Place the reservation
-                        logger.info("Placing reservation for {0} by user: Server {1}".format(user, server))
-                        self._xmpp.send_message(cmdtype, target, "Placing server reservation, waiting for response... use '{0}{1} cancel' to abort.".format(self._config.bot.command_prefix, self.name))
-                        self.place_reservation(cmdtype, target, user, server)
+                    # Place the reservation
+                    logger.info("Placing reservation for {0} by user: Server {1}".format(user, server))
+                    self._xmpp.send_message(cmdtype, target, "Placing server reservation, waiting for response... use '{0}{1} cancel' to abort.".format(self._config.bot.command_prefix, self.name))
+                    self.place_reservation(cmdtype, target, user, server)
 
     def server(self, cmdtype, cmdname, args, target, user, party):
         # Check arguments
@@ -260,7 +471,7 @@ class SpectatorPlugin(BasePlugin):
             self._xmpp.send_message(cmdtype, target, "Missing target server.")
         else:
             # Get the server
-            servers = self._api.get_server_by_name(args[0])
+            servers = self._servers.find_by_name(args[0])
 
             # Check if the server exists
             if servers is False:
@@ -272,10 +483,10 @@ class SpectatorPlugin(BasePlugin):
             else:
                 server = servers[0]
 
-                # Place the reservation
+                # Place the reservation, reloading the server so the checks see its current state
                 logger.info("Placing reservation for {0} by server: Server {1}".format(user, server["Guid"]))
                 self._xmpp.send_message(cmdtype, target, "Placing server reservation, waiting for response... use '{0}{1} cancel' to abort.".format(self._config.bot.command_prefix, self.name))
-                self.place_reservation(cmdtype, target, user, server)
+                self.place_reservation(cmdtype, target, user, server["Guid"])
 
 
 plugin = SpectatorPlugin
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import threading
 from contextlib import contextmanager
 from datetime import datetime
-from sqlalchemy import func, create_engine
-from sqlalchemy.orm import sessionmaker
 from scrimbot.command import CommandType
 from scrimbot.plugins.base import BasePlugin
-from scrimbot.plugins.tracker.model import Player, User, LinkStatus
 
 
 class TrackerPlugin(BasePlugin):
@@ -24,16 +22,17 @@ class TrackerPlugin(BasePlugin):
         #self.register_command(CommandType.PM, "link", self.link)
         #self.register_command(CommandType.PM, "unlink", self.unlink)
 
-        # Setup database connection
+        # Check the database connection settings - the connection is setup on first use
         if self._config.plugins.tracker.database_uri is None:
             raise ValueError("The database URI must be set")
 
-        engine = create_engine(self._config.plugins.tracker.database_uri)
-        self.session = sessionmaker(bind=engine)
+        self.session = None
+        self._session_lock = threading.Lock()
 
     def disable(self):
         # Close database sessions
-        self.session.close_all()
+        if self.session is not None:
+            self.session.close_all()
 
     def connected(self):
         pass
@@ -41,8 +40,21 @@ class TrackerPlugin(BasePlugin):
     def disconnected(self):
         pass
 
+    def _setup_database(self):
+        # SQLAlchemy is heavy to import, so defer it until the database is needed
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        engine = create_engine(self._config.plugins.tracker.database_uri)
+        self.session = sessionmaker(bind=engine)
+
     @contextmanager
     def db_session(self):
+        if self.session is None:
+            with self._session_lock:
+                if self.session is None:
+                    self._setup_database()
+
         session = self.session()
         try:
             yield session
@@ -54,6 +66,8 @@ class TrackerPlugin(BasePlugin):
             session.close()
 
     def opt_in(self, cmdtype, cmdname, args, target, user, party):
+        from scrimbot.plugins.tracker.model import Player
+
         success = False
         with self.db_session() as session:
             player = session.query(Player).get(user)
@@ -71,6 +85,8 @@ class TrackerPlugin(BasePlugin):
             self._xmpp.send_message(cmdtype, target, "You have successfully opted into the leaderboards.")
 
     def opt_out(self, cmdtype, cmdname, args, target, user, party):
+        from scrimbot.plugins.tracker.model import Player
+
         success = False
         with self.db_session() as session:
             player = session.query(Player).get(user)
@@ -98,6 +114,9 @@ class TrackerPlugin(BasePlugin):
             self._xmpp.send_message(cmdtype, target, "You have successfully opted out of the leaderboards.")
 
     def link(self, cmdtype, cmdname, args, target, user, party):
+        from sqlalchemy import func
+        from scrimbot.plugins.tracker.model import Player, User, LinkStatus
+
         # Check args
         if len(args) < 1:
             self._xmpp.send_message(cmdtype, target, "Error: You must specify the user you wish to link your Hawken account to.")
@@ -156,6 +175,8 @@ class TrackerPlugin(BasePlugin):
                 self._xmpp.send_message(cmdtype, target, "You have linked your Hawken account to {0}, but the link is pending confirmation. Please login to the leaderboards site and confirm the link.".format(username))
 
     def unlink(self, cmdtype, cmdname, args, target, user, party):
+        from scrimbot.plugins.tracker.model import Player, LinkStatus
+
         success = True
         username = None
         with self.db_session() as session:
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import concurrent.futures
+from scrimbot.util import chunks
+
+logger = logging.getLogger(__name__)
+
+
+class UserResolver:
+    def __init__(self, config, cache, api):
+        self.config = config
+        self.cache = cache
+        self.api = api
+
+        self._lock = threading.Lock()
+        self._pending = {"callsign": {}, "guid": {}}
+        self._timer = None
+        self._guids = None
+
+        # Register config
+        self.config.register("api.resolver.window", 0.05)
+        self.config.register("api.resolver.batch_size", 100)
+
+    def _guid_index(self):
+        # Build the reverse lookup from the callsign cache on first use
+        if self._guids is None:
+            self._guids = {callsign.lower(): guid for guid, callsign in self.cache["callsign"].items() if callsign}
+
+        return self._guids
+
+    def _store(self, guid, callsign):
+        # Fill the local cache with the resolved user
+        if self.cache["callsign"].get(guid) != callsign:
+            self.cache["callsign"][guid] = callsign
+        self._guid_index()[callsign.lower()] = guid
+
+    def _queue(self, kind, keys):
+        futures = {}
+
+        with self._lock:
+            pending = self._pending[kind]
+            for key in keys:
+                if key not in pending:
+                    pending[key] = concurrent.futures.Future()
+                futures[key] = pending[key]
+
+            # Start the batch window if one isn't already open
+            if self._timer is None:
+                self._timer = threading.Timer(self.config.api.resolver.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        return futures
+
+    def _flush(self):
+        # Take the pending lookups, opening a new window for later callers
+        with self._lock:
+            pending = self._pending
+            self._pending = {"callsign": {}, "guid": {}}
+            self._timer = None
+
+        if len(pending["callsign"]) > 0:
+            self._resolve(pending["callsign"], self.api.get_user_callsign, self._store_callsigns)
+
+        if len(pending["guid"]) > 0:
+            self._resolve(pending["guid"], self.api.get_user_guid, self._store_guids)
+
+    def _resolve(self, pending, lookup, store):
+        for batch in chunks(list(pending.keys()), self.config.api.resolver.batch_size):
+            try:
+                results = store(batch, lookup(batch))
+            except Exception as e:
+                logger.exception("Failed to resolve batch of {0} user(s).".format(len(batch)))
+                for key in batch:
+                    pending[key].set_exception(e)
+            else:
+                for key in batch:
+                    pending[key].set_result(results.get(key))
+
+    def _store_callsigns(self, batch, data):
+        results = {}
+        for guid in batch:
+            callsign = data.get(guid)
+            if callsign is not None:
+                self._store(guid, callsign)
+                results[guid] = callsign
+
+        return results
+
+    def _store_guids(self, batch, data):
+        # Match the callsigns case-insensitively, as the API returns the canonical callsign
+        index = {}
+        for callsign, guid in data.items():
+            if guid is not None:
+                self._store(guid, callsign)
+                index[callsign.lower()] = guid
+
+        results = {}
+        for callsign in batch:
+            guid = index.get(callsign.lower())
+            if guid is not None:
+                results[callsign] = guid
+
+        return results
+
+    def _wait(self, futures):
+        return {key: future.result() for key, future in futures.items()}
+
+    def get_callsigns(self, users, cache_bypass=False):
+        results = {}
+        missing = []
+
+        # Check the local cache first
+        for user in set(users):
+            callsign = None if cache_bypass else self.cache["callsign"].get(user)
+            if callsign:
+                results[user] = callsign
+            else:
+                missing.append(user)
+
+        if len(missing) > 0:
+            for user, callsign in self._wait(self._queue("callsign", missing)).items():
+                if callsign is not None:
+                    results[user] = callsign
+
+        return results
+
+    def get_callsign(self, user, cache_bypass=False):
+        return self.get_callsigns([user], cache_bypass=cache_bypass).get(user)
+
+    def get_guids(self, callsigns, cache_bypass=False):
+        results = {}
+        missing = []
+
+        # Check the local cache first
+        for callsign in set(callsigns):
+            guid = None if cache_bypass else self._guid_index().get(callsign.lower())
+            if guid:
+                results[callsign] = guid
+            else:
+                missing.append(callsign)
+
+        if len(missing) > 0:
+            for callsign, guid in self._wait(self._queue("guid", missing)).items():
+                if guid is not None:
+                    results[callsign] = guid
+
+        return results
+
+    def get_guid(self, callsign, cache_bypass=False):
+        return self.get_guids([callsign], cache_bypass=cache_bypass).get(callsign)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+class RoomRouter:
+    def __init__(self):
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, room):
+        return room in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def register(self, room, handlers, session_end=None):
+        with self._lock:
+            # Rejoining a room replaces its old handlers
+            self._rooms[room] = (handlers, session_end)
+            metrics.gauge("rooms", len(self._rooms))
+
+    def unregister(self, room):
+        with self._lock:
+            # The room may already be gone if the session ended
+            self._rooms.pop(room, None)
+            metrics.gauge("rooms", len(self._rooms))
+
+    def dispatch(self, event):
+        room, kind, data = event
+
+        try:
+            handlers, session_end = self._rooms[room]
+            handler = handlers[kind]
+        except KeyError:
+            return
+
+        metrics.increment("events")
+        handler(data)
+
+    def session_end(self, event):
+        # Tear down every room at once, then let each one reset itself
+        with self._lock:
+            rooms = list(self._rooms.values())
+            self._rooms.clear()
+            metrics.gauge("rooms", 0)
+
+        for handlers, session_end in rooms:
+            if session_end is not None:
+                try:
+                    session_end(event)
+                except Exception:
+                    logger.exception("Exception in room session_end handler.")
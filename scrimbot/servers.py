@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import time
+import types
+import logging
+import threading
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+def _freeze(index):
+    return types.MappingProxyType({key: tuple(value) for key, value in index.items()})
+
+
+class ServerSnapshot:
+    def __init__(self, version, servers, timestamp=None):
+        self.version = version
+        self.timestamp = timestamp or time.time()
+        self.servers = tuple(servers)
+
+        # Build the indexes
+        guids = {}
+        names = {}
+        regions = {}
+        gametypes = {}
+        for server in self.servers:
+            guids[server["Guid"]] = server
+            names.setdefault(server["ServerName"].lower(), []).append(server)
+            regions.setdefault(server["Region"].lower(), []).append(server)
+            gametypes.setdefault(server["GameType"].lower(), []).append(server)
+
+        self.by_guid = types.MappingProxyType(guids)
+        self.by_name = _freeze(names)
+        self.by_region = _freeze(regions)
+        self.by_gametype = _freeze(gametypes)
+
+    @property
+    def age(self):
+        return time.time() - self.timestamp
+
+    def get(self, guid):
+        return self.by_guid.get(guid)
+
+    def find_by_name(self, name):
+        return list(self.by_name.get(name.lower(), ()))
+
+    def in_region(self, region):
+        return list(self.by_region.get(region.lower(), ()))
+
+    def with_gametype(self, gametype):
+        return list(self.by_gametype.get(gametype.lower(), ()))
+
+
+def diff_servers(old, new):
+    # Compare two snapshots and list the changes as (event, args) pairs
+    changes = []
+    old_servers = old.by_guid if old is not None else {}
+
+    for guid, server in new.by_guid.items():
+        try:
+            previous = old_servers[guid]
+        except KeyError:
+            changes.append(("added", (server, )))
+            if len(server["Users"]) > 0:
+                changes.append(("joined", (server, set(server["Users"]))))
+            continue
+
+        if previous["Users"] != server["Users"]:
+            before = set(previous["Users"])
+            after = set(server["Users"])
+            if len(after - before) > 0:
+                changes.append(("joined", (server, after - before)))
+            if len(before - after) > 0:
+                changes.append(("left", (server, before - after)))
+
+        if previous["ServerRanking"] != server["ServerRanking"]:
+            changes.append(("ranking", (server, previous)))
+
+        if previous["DeveloperData"]["MatchState"] != server["DeveloperData"]["MatchState"]:
+            changes.append(("state", (server, previous)))
+
+    for guid, server in old_servers.items():
+        if guid not in new.by_guid:
+            if len(server["Users"]) > 0:
+                changes.append(("left", (server, set(server["Users"]))))
+            changes.append(("removed", (server, )))
+
+    return changes
+
+
+class PresenceIndex:
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+        self.version = 0
+        self.timestamp = None
+
+    def apply(self, changes, snapshot):
+        count = 0
+
+        with self._lock:
+            for event, args in changes:
+                if event == "joined":
+                    server, users = args
+                    for user in users:
+                        self._users[user] = server["Guid"]
+                    count += len(users)
+                elif event == "left":
+                    server, users = args
+                    for user in users:
+                        # Don't clobber the user if they already showed up on another server
+                        if self._users.get(user) == server["Guid"]:
+                            del self._users[user]
+                    count += len(users)
+
+            self.version = snapshot.version
+            self.timestamp = snapshot.timestamp
+
+        metrics.increment("presence_changes", count)
+        metrics.gauge("presence_users", len(self._users))
+
+    @property
+    def age(self):
+        if self.timestamp is None:
+            return None
+
+        return time.time() - self.timestamp
+
+    def get(self, user):
+        return self._users.get(user)
+
+
+class ServerDirectory:
+    def __init__(self, config, api, scheduler):
+        self.config = config
+        self.api = api
+        self.scheduler = scheduler
+
+        self._snapshot = None
+        self._version = 0
+        self.presence = PresenceIndex()
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()
+        self._refreshing = False
+
+        self.event_handlers = {}
+        for event in ("added", "removed", "joined", "left", "ranking", "state"):
+            self.event_handlers[event] = set()
+
+        # Register config
+        self.config.register("api.servers.refresh", 30)
+        self.config.register("api.servers.max_age", 120)
+        self.config.register("api.servers.presence_max_age", 60)
+
+    def start(self):
+        # Load the initial snapshot and keep it up to date in the background
+        self.refresh()
+        self.scheduler.add("server_directory", self.config.api.servers.refresh, self.refresh_background, repeat=True)
+
+    def stop(self):
+        self.scheduler.remove("server_directory")
+
+    def refresh(self):
+        start = time.time()
+        try:
+            servers = self.api.get_server_list()
+        except Exception:
+            logger.exception("Failed to refresh the server list.")
+            servers = False
+
+        if servers is False or servers is None:
+            metrics.increment("refresh_failures")
+            return self._snapshot
+
+        with self._dispatch_lock:
+            with self._lock:
+                self._version += 1
+                snapshot = ServerSnapshot(self._version, servers)
+                changes = diff_servers(self._snapshot, snapshot)
+                self.presence.apply(changes, snapshot)
+                self._snapshot = snapshot
+
+            # Send out the changes before the next snapshot can be applied, so handlers see them in order
+            self._dispatch(changes)
+
+        metrics.timing("refresh", time.time() - start)
+        metrics.gauge("servers", len(snapshot.servers))
+        metrics.gauge("version", snapshot.version)
+
+        return snapshot
+
+    def _dispatch(self, changes):
+        for event, args in changes:
+            metrics.increment("events.{0}".format(event))
+            for handler in list(self.event_handlers[event]):
+                try:
+                    handler(*args)
+                except Exception:
+                    logger.exception("Exception in server {0} event handler.".format(event))
+
+    def register_event(self, event, handler):
+        self.event_handlers[event].add(handler)
+
+    def unregister_event(self, event, handler):
+        self.event_handlers[event].remove(handler)
+
+    def _refresh_background(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+
+    def refresh_background(self):
+        # Refresh in another thread so the timer thread is never blocked on the API, skipping if one is running
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = threading.Thread(target=self._refresh_background, name="server_directory")
+        thread.daemon = True
+        thread.start()
+
+    def snapshot(self):
+        snapshot = self._snapshot
+
+        # Block on a refresh if there is no usable snapshot, otherwise serve it and revalidate in the background
+        if snapshot is None or snapshot.age > self.config.api.servers.max_age:
+            metrics.increment("misses")
+            return self.refresh()
+        elif snapshot.age > self.config.api.servers.refresh:
+            metrics.increment("stale")
+            self.refresh_background()
+        else:
+            metrics.increment("hits")
+
+        return snapshot
+
+    def find_by_name(self, name):
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return False
+
+        return snapshot.find_by_name(name)
+
+    def get(self, guid, fresh=False):
+        # Fresh data has to come from the API
+        if fresh:
+            return self.api.get_server(guid)
+
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return self.api.get_server(guid)
+
+        server = snapshot.get(guid)
+        if server is None:
+            # Might be a new server
+            return self.api.get_server(guid)
+
+        return server
+
+    def user_server(self, user):
+        # Answer from the presence index if it is recent enough, otherwise ask the API
+        age = self.presence.age
+        if age is not None and age <= self.config.api.servers.presence_max_age:
+            metrics.increment("presence_hits")
+            return self.presence.get(user)
+
+        metrics.increment("presence_misses")
+        servers = self.api.get_user_server(user, cache_bypass=True)
+        if servers is None:
+            return None
+
+        return servers[0]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import collections
+import concurrent.futures
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+class StartupPipeline:
+    def __init__(self):
+        self._steps = collections.OrderedDict()
+        self.timings = collections.OrderedDict()
+
+    def add(self, name, callback, requires=()):
+        if name in self._steps:
+            raise ValueError("Step {0} is already registered".format(name))
+
+        for requirement in requires:
+            if requirement not in self._steps:
+                raise ValueError("Step {0} requires unknown step {1}".format(name, requirement))
+
+        self._steps[name] = (callback, set(requires))
+
+    def _run_step(self, name, callback):
+        start = time.time()
+        callback()
+        elapsed = time.time() - start
+
+        logger.debug("Startup step {0} finished in {1:.3f}s.".format(name, elapsed))
+
+        return elapsed
+
+    def run(self, max_workers=4):
+        start = time.time()
+        exception = None
+        done = set()
+        waiting = collections.OrderedDict(self._steps)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+
+            while len(waiting) > 0 or len(running) > 0:
+                # Submit every step that has its requirements met
+                if exception is None:
+                    for name, (callback, requires) in list(waiting.items()):
+                        if requires <= done:
+                            running[executor.submit(self._run_step, name, callback)] = name
+                            del waiting[name]
+
+                if len(running) == 0:
+                    break
+
+                # Wait for a step to complete
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+
+                    try:
+                        self.timings[name] = future.result()
+                    except Exception as e:
+                        logger.error("Startup step {0} failed.".format(name))
+
+                        # Save the first exception and stop submitting steps
+                        if exception is None:
+                            exception = e
+                    else:
+                        done.add(name)
+                        metrics.gauge(name, self.timings[name])
+
+        if exception is not None:
+            raise exception
+
+        elapsed = time.time() - start
+        self.timings["total"] = elapsed
+        metrics.gauge("total", elapsed)
+
+        logger.info("Startup completed in {0:.3f}s ({1}).".format(elapsed, ", ".join("{0} {1:.3f}s".format(name, timing) for name, timing in self.timings.items() if name != "total")))
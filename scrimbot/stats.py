@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from scrimbot.metrics import get_metrics
+from scrimbot.util import chunks
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+# Fields that change after every match, and go stale quickly
+mmr_fields = ("MatchMaking.Rating", "MatchMaking.Rating.Seasonal")
+
+
+class PlayerStatsStore:
+    def __init__(self, config, api):
+        self.config = config
+        self.api = api
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pruned = time.time()
+        self._hits = 0
+        self._misses = 0
+
+        # Register config
+        self.config.register("api.stats.ttl.default", 300)
+        self.config.register("api.stats.ttl.mmr", 60)
+        self.config.register("api.stats.batch_size", 100)
+
+    def _ttl(self, fields):
+        # The entry is only as fresh as its most volatile requested field
+        if fields is None:
+            fields = mmr_fields
+
+        ttl = self.config.api.stats.ttl.default
+        for field in fields:
+            if field in mmr_fields:
+                ttl = min(ttl, self.config.api.stats.ttl.mmr)
+
+        return ttl
+
+    def _lookup(self, guids, fields, cache_bypass):
+        found = {}
+        missing = []
+
+        if cache_bypass:
+            missing = list(guids)
+        else:
+            cutoff = time.time() - self._ttl(fields)
+            with self._lock:
+                for guid in guids:
+                    try:
+                        stats, fetched = self._entries[guid]
+                    except KeyError:
+                        missing.append(guid)
+                    else:
+                        if fetched < cutoff:
+                            missing.append(guid)
+                        else:
+                            found[guid] = stats
+
+        self._record(len(found), len(missing))
+
+        return found, missing
+
+    def _record(self, hits, misses):
+        with self._lock:
+            self._hits += hits
+            self._misses += misses
+            total = self._hits + self._misses
+
+        metrics.increment("hits", hits)
+        metrics.increment("misses", misses)
+        if total > 0:
+            metrics.gauge("hit_rate", self._hits / total)
+
+    def _store(self, stats):
+        now = time.time()
+        with self._lock:
+            for entry in stats:
+                self._entries[entry["Guid"]] = (entry, now)
+
+            # Every so often, drop the entries that are too old to be served for any fields
+            if now - self._pruned > self.config.api.stats.ttl.mmr:
+                self._prune(now)
+
+            metrics.gauge("entries", len(self._entries))
+
+    def _prune(self, now):
+        cutoff = now - max(self.config.api.stats.ttl.default, self.config.api.stats.ttl.mmr)
+        expired = [guid for guid, (entry, fetched) in self._entries.items() if fetched < cutoff]
+        for guid in expired:
+            del self._entries[guid]
+
+        self._pruned = now
+        metrics.increment("pruned", len(expired))
+
+    def get(self, guid, fields=None, cache_bypass=False):
+        found, missing = self._lookup((guid, ), fields, cache_bypass)
+
+        if len(missing) > 0:
+            stats = self.api.get_user_stats(guid, cache_bypass=cache_bypass)
+            metrics.increment("requests")
+            if stats is None:
+                return None
+
+            self._store((stats, ))
+            return stats
+
+        return found[guid]
+
+    def get_many(self, guids, fields=None, cache_bypass=False):
+        guids = list(guids)
+        found, missing = self._lookup(set(guids), fields, cache_bypass)
+
+        # Only request the players we don't have fresh stats for
+        for batch in chunks(missing, self.config.api.stats.batch_size):
+            stats = self.api.get_user_stats(batch, cache_bypass=cache_bypass)
+            metrics.increment("requests")
+
+            self._store(stats)
+            for entry in stats:
+                found[entry["Guid"]] = entry
+
+        return [found[guid] for guid in guids if guid in found]
+
+    def invalidate(self, guid):
+        with self._lock:
+            self._entries.pop(guid, None)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from scrimbot.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics(__name__)
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "kwargs", "interval", "jitter", "name", "canceled", "_service")
+
+    def __init__(self, service, deadline, callback, args, kwargs, interval, jitter, name):
+        self._service = service
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.jitter = jitter
+        self.name = name
+        self.canceled = False
+
+    def cancel(self):
+        self._service.cancel(self)
+
+    @property
+    def active(self):
+        return not self.canceled
+
+
+class TimerService:
+    def __init__(self, max_wait=1.0):
+        self.max_wait = max_wait
+        self.stop = threading.Event()
+
+        self._lock = threading.Condition()
+        self._heap = []
+        self._named = {}
+        self._counter = itertools.count()
+        self._canceled = 0
+        self._thread = None
+
+    def _push(self, timer):
+        heapq.heappush(self._heap, (timer.deadline, next(self._counter), timer))
+        metrics.gauge("timers", len(self._heap) - self._canceled)
+
+        # Wake up the timer thread if this is the new earliest timer
+        if self._heap[0][2] is timer:
+            self._lock.notify()
+
+    def _compact(self):
+        # Drop canceled timers once they make up most of the heap
+        if self._canceled > 64 and self._canceled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[2].canceled]
+            heapq.heapify(self._heap)
+            self._canceled = 0
+
+    def _next(self):
+        with self._lock:
+            while not self.stop.is_set():
+                # Skip over canceled timers
+                while len(self._heap) > 0 and self._heap[0][2].canceled:
+                    heapq.heappop(self._heap)
+                    self._canceled -= 1
+
+                if len(self._heap) == 0:
+                    self._lock.wait(self.max_wait)
+                    continue
+
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._lock.wait(min(wait, self.max_wait))
+                    continue
+
+                timer = heapq.heappop(self._heap)[2]
+                drift = time.time() - timer.deadline
+                metrics.gauge("timers", len(self._heap) - self._canceled)
+
+                if timer.interval is None:
+                    # One-shot timers are done once they fire
+                    timer.canceled = True
+                    if timer.name is not None and self._named.get(timer.name) is timer:
+                        del self._named[timer.name]
+                else:
+                    # Reschedule repeating timers off the deadline, so drift does not accumulate
+                    timer.deadline = max(timer.deadline + timer.interval, time.time()) + self._jitter(timer.jitter)
+                    self._push(timer)
+
+                return timer, drift
+
+        return None, None
+
+    def _jitter(self, jitter):
+        if jitter > 0:
+            return random.uniform(0, jitter)
+
+        return 0
+
+    def _process(self):
+        while True:
+            timer, drift = self._next()
+            if timer is None:
+                break
+
+            # Record how late the timer fired
+            metrics.timing("drift", drift)
+
+            try:
+                timer.callback(*timer.args, **timer.kwargs)
+            except Exception:
+                logger.exception("Exception in timer {0}.".format(timer.name or timer.callback))
+
+            metrics.increment("fired")
+
+    def process(self, threaded=True):
+        if threaded:
+            self._thread = threading.Thread(target=self._process, name="timers")
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._process()
+
+    def schedule(self, seconds, callback, args=None, kwargs=None, repeat=False, jitter=0, name=None):
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+
+        with self._lock:
+            timer = Timer(self, time.time() + seconds + self._jitter(jitter), callback, args, kwargs, seconds if repeat else None, jitter, name)
+            self._push(timer)
+
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            if not timer.canceled:
+                timer.canceled = True
+                self._canceled += 1
+                metrics.gauge("timers", len(self._heap) - self._canceled)
+                self._compact()
+
+            if timer.name is not None and self._named.get(timer.name) is timer:
+                del self._named[timer.name]
+
+    def add(self, name, seconds, callback, args=None, kwargs=None, repeat=False, jitter=0):
+        with self._lock:
+            if name in self._named:
+                raise ValueError("Task {0} is already registered".format(name))
+
+            self._named[name] = self.schedule(seconds, callback, args, kwargs, repeat, jitter, name)
+
+        logger.debug("Registered task: {0}".format(name))
+
+    def remove(self, name):
+        with self._lock:
+            try:
+                timer = self._named[name]
+            except KeyError:
+                return
+
+            self.cancel(timer)
+
+        logger.debug("Unregistered task: {0}".format(name))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import math
+import heapq
 import ctypes
 import logging.config
 import collections
@@ -290,6 +291,8 @@ def stat_analysis(data, stat):
     stats = {"list": [item[stat] for item in data if stat in item and item[stat] is not None]}
 
     if len(stats["list"]) > 0:
+        stats["count"] = len(stats["list"])
+
         # Calculate min/max/mean
         stats["max"] = max(stats["list"])
         stats["min"] = min(stats["list"])
@@ -306,6 +309,93 @@ def stat_analysis(data, stat):
         return False
 
 
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+        self._values = collections.Counter()
+        self._min = []
+        self._max = []
+        self._removed_min = collections.Counter()
+        self._removed_max = collections.Counter()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+
+        self._values[value] += 1
+        heapq.heappush(self._min, value)
+        heapq.heappush(self._max, -value)
+
+    def remove(self, value):
+        if self._values[value] < 1:
+            raise ValueError("Value {0} is not in the aggregate".format(value))
+
+        self._values[value] -= 1
+        if self._values[value] == 0:
+            del self._values[value]
+
+        self.count -= 1
+        if self.count == 0:
+            # Start over from a clean slate, so rounding errors don't build up
+            self.__init__()
+            return
+
+        self.total -= value
+        self.total_squares -= value * value
+
+        # Removed values are dropped from the heaps lazily
+        self._removed_min[value] += 1
+        self._removed_max[value] += 1
+        if len(self._min) > self.count * 2 + 16:
+            self._compact()
+
+    def _compact(self):
+        self._min = list(self._values.elements())
+        self._max = [-value for value in self._min]
+        heapq.heapify(self._min)
+        heapq.heapify(self._max)
+        self._removed_min.clear()
+        self._removed_max.clear()
+
+    def _top(self, heap, removed, sign):
+        while removed[sign * heap[0]] > 0:
+            removed[sign * heap[0]] -= 1
+            heapq.heappop(heap)
+
+        return sign * heap[0]
+
+    @property
+    def min(self):
+        return self._top(self._min, self._removed_min, 1)
+
+    @property
+    def max(self):
+        return self._top(self._max, self._removed_max, -1)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def stddev(self):
+        return math.sqrt(max(0.0, self.total_squares / self.count - self.mean ** 2))
+
+    def analysis(self):
+        # Same format as stat_analysis, without the value list
+        if self.count == 0:
+            return False
+
+        return {"count": self.count, "min": self.min, "max": self.max, "mean": self.mean, "stddev": self.stddev}
+
+
+# Player stats used by the fitness calculation
+fitness_fields = ("GameMode.All.TotalMatches", "MatchMaking.Rating", "Progress.Pilot.Level")
+
+
 def calc_fitness(globals_info, player, server):
     # Get shared values
     weight_rank = int(globals_info["MMGlickoWeight"])